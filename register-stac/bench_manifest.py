@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# 20261018 BENCHMARK: manifest fileLocation/@href extraction
+# bs4 tree [ the former get_source_metadata_all ] against the streaming
+# xml_iter of register-stac.py, wall time and the python heap peak
+#
+# Usage:
+# ./bench_manifest.py                  synthetic S1 SLC like manifest
+# ./bench_manifest.py -n 50000         synthetic manifest, 50000 data objects
+# ./bench_manifest.py manifest.safe .. real manifests
+#
+# bs4 and lxml are needed for the bs4 side only
+
+import getopt
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bs4 as bs
+
+RS_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "register-stac.py")
+BENCH_OBJECTS = 20000
+BENCH_ROUNDS = 3
+
+
+def load_rs():
+    spec = importlib.util.spec_from_file_location("register_stac", RS_FNAME)
+    rs = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(rs)  # main() is behind the __main__ guard
+    return rs
+
+
+def synth_manifest(fname, n):
+    with open(fname, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(
+            '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1"'
+            ' version="esa/safe/sentinel-1.0">\n'
+        )
+        f.write("<metadataSection>\n")
+        for i in range(n // 10):
+            f.write(
+                f'<metadataObject ID="m{i}"><metadataWrap mimeType="text/xml">'
+                f"<xmlData><safe:platform xmlns:safe=\"http://www.esa.int/safe/sentinel-1.0\">"
+                f"<safe:familyName>SENTINEL-1</safe:familyName><safe:number>A</safe:number>"
+                f"</safe:platform></xmlData></metadataWrap></metadataObject>\n"
+            )
+        f.write("</metadataSection>\n<dataObjectSection>\n")
+        exts = (".xml", ".tiff", ".xml", ".jp2", ".gml", ".xml")
+        for i in range(n):
+            f.write(
+                f'<dataObject ID="d{i}" repID="r"><byteStream mimeType="text/xml" size="{i}">'
+                f'<fileLocation locatorType="URL"'
+                f' href="./annotation/s1a-iw{i % 3}-slc-{i}{exts[i % 6]}"/>'
+                f'<checksum checksumName="MD5">{i:032x}</checksum></byteStream></dataObject>\n'
+            )
+        f.write("</dataObjectSection>\n</xfdu:XFDU>\n")
+
+
+def hrefs_bs4(fname):
+    with open(fname, "rb") as f:
+        src_mnfst = bs.BeautifulSoup(f.read(), features="xml")
+    return [val.get("href") for val in src_mnfst.find_all("fileLocation")]
+
+
+def hrefs_stream(rs, fname):
+    return [val.get("href") for val in rs.xml_iter(fname, ("fileLocation",))]
+
+
+def bench(name, fn, *args):
+    best = None
+    for _ in range(BENCH_ROUNDS):
+        t0 = time.perf_counter()
+        res = fn(*args)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(
+        f"[ {name:6} ][ {len(res):7} hrefs ][ {best * 1000:9.1f} ms ]"
+        f"[ peak {peak / 2**20:8.1f} MB ]"
+    )
+    return res
+
+
+def main():
+    n = BENCH_OBJECTS
+    opts, fnames = getopt.getopt(sys.argv[1:], "n:")
+    for opt, val in opts:
+        if opt == "-n":
+            n = int(val)
+    rs = load_rs()
+    tmp = None
+    if not fnames:
+        tmp = tempfile.NamedTemporaryFile(suffix=".safe", delete=False)
+        tmp.close()
+        synth_manifest(tmp.name, n)
+        fnames = [tmp.name]
+    try:
+        for fname in fnames:
+            print(f"[ {fname} {os.path.getsize(fname) / 2**20:.1f} MB ]")
+            a = bench("bs4", hrefs_bs4, fname)
+            b = bench("stream", hrefs_stream, rs, fname)
+            print(f"[ same result: {a == b} ]")
+    finally:
+        if tmp:
+            os.remove(tmp.name)
+
+
+if __name__ == "__main__":
+    main()
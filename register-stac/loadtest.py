@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# 20261018 LOAD TEST: the registration pipeline against local stand-ins
+# a DHuS OData server [ Products entry, Nodes feed, manifest, $value files ]
+# with latency, bandwidth and error rate, a resto items / search server and
+# a create_item stand-in for stactools, register_batch of register-stac.py
+# runs N products against them, reports products/min, bytes/s and the
+# p50 / p95 stage latencies
+#
+# Usage:
+# ./loadtest.py -n 100
+# ./loadtest.py -n 500 -w 8 --latency 50 --bandwidth 20 --error-rate 0.01
+#
+# Options:
+# -n N               products [ 20 ]
+# -w N               stac item workers [ 2 ]
+# --files N          metadata files per product [ 5 ]
+# --file-size KB     size of a metadata file [ 256 ]
+# --latency MS       dhus and resto response latency [ 0 ]
+# --bandwidth MB     dhus bandwidth per response in MB/s [ 0 unlimited ]
+# --error-rate R     share of dhus requests answered 503 [ 0 ]
+# --corrupt-rate R   share of metadata files served with a flipped byte [ 0 ]
+# --upload-batch N   items per FeatureCollection [ 50 ]
+# --keep             keep the temporary directory
+
+import getopt
+import hashlib
+import importlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+RS_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "register-stac.py")
+
+LT_OPTS = {
+    "n": 20,
+    "workers": 2,
+    "files": 5,
+    "file_size": 256,
+    "latency": 0.0,
+    "bandwidth": 0.0,
+    "error_rate": 0.0,
+    "corrupt_rate": 0.0,
+    "upload_batch": 50,
+    "keep": False,
+}
+LT_CHUNK = 64 * 1024
+LT_PRODUCTS = {}  # uuid -> product name
+LT_STATS = {"dhus": 0, "dhus_err": 0, "dhus_bytes": 0, "dhus_corrupt": 0, "resto": 0}
+LT_LOCK = threading.Lock()
+
+ATOM_NS = (
+    'xmlns="http://www.w3.org/2005/Atom" '
+    'xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata" '
+    'xmlns:d="http://schemas.microsoft.com/ado/2007/08/dataservices"'
+)
+
+# create_item stand-in, imported by the stac pool workers from LT_DIR
+FAKE_STAC = """
+import json
+import os
+
+
+class Item:
+    def __init__(self, href):
+        self.node = os.path.basename(href.rstrip("/"))
+        self.id = self.node.split(".")[0]
+        self.href = None
+
+    def set_self_href(self, href):
+        self.href = href
+
+    def get_self_href(self):
+        return self.href
+
+    def make_asset_hrefs_relative(self):
+        pass
+
+    def save_object(self):
+        doc = {
+            "type": "Feature",
+            "stac_version": "1.0.0",
+            "id": self.id,
+            "geometry": {"type": "Point", "coordinates": [14.4, 50.1]},
+            "bbox": [14.4, 50.1, 14.4, 50.1],
+            "properties": {"datetime": "2023-01-01T00:00:00Z"},
+            "links": [],
+            "assets": {
+                "metadata": {"href": self.node + "/MTD_MSIL2A.xml"},
+                "manifest": {"href": self.node + "/manifest.safe"},
+            },
+        }
+        with open(self.href, "w") as f:
+            json.dump(doc, f)
+
+
+def create_item(href):
+    return Item(href)
+"""
+
+
+def lt_count(key, value=1):
+    with LT_LOCK:
+        LT_STATS[key] += value
+
+
+def lt_payload(size, cache={}):
+    if size not in cache:
+        cache[size] = os.urandom(size)
+    return cache[size]
+
+
+def lt_manifest(node):
+    md5 = hashlib.md5(lt_payload(LT_OPTS["file_size"] * 1024)).hexdigest()
+    files = [
+        f"./GRANULE/L2A_T33UVR/QI_DATA/QI_{idx}.xml"
+        for idx in range(LT_OPTS["files"] - 1)
+    ]
+    files = ["./MTD_MSIL2A.xml"] + files + ["./GRANULE/L2A_T33UVR/IMG_DATA/B01.jp2"]
+    objs = "".join(
+        f'<dataObject ID="d{idx}"><byteStream mimeType="text/xml">'
+        f'<fileLocation locatorType="URL" href="{href}"/>'
+        f'<checksum checksumName="MD5">{md5}</checksum></byteStream></dataObject>'
+        for idx, href in enumerate(files)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1">'
+        f"<dataObjectSection>{objs}</dataObjectSection></xfdu:XFDU>"
+    ).encode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body=b"", ctype="application/octet-stream", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        if code != 304:
+            self.send_header("Content-Length", str(len(body)))
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        bw = LT_OPTS["bandwidth"] * 1024 * 1024
+        for idx in range(0, len(body), LT_CHUNK):
+            end = idx + LT_CHUNK
+            chunk = body[idx:end]
+            self.wfile.write(chunk)
+            if bw:
+                time.sleep(len(chunk) / bw)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+
+class DhusHandler(Handler):
+    ODATA_RE = re.compile(r"^/odata/v1/Products\('([^']+)'\)(.*)$")
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if LT_OPTS["latency"]:
+            time.sleep(LT_OPTS["latency"])
+        lt_count("dhus")
+        if random.random() < LT_OPTS["error_rate"]:
+            lt_count("dhus_err")
+            self.reply(503, b"busy", "text/plain")
+            return
+        m = self.ODATA_RE.match(self.path.split("?")[0])
+        name = LT_PRODUCTS.get(m.group(1)) if m else None
+        if name is None:
+            self.reply(404, b"not found", "text/plain")
+            return
+        rest = m.group(2)
+        node = name + ".SAFE"
+        if rest == "":
+            body = (
+                f"<entry {ATOM_NS}><id>{m.group(1)}</id><title>{name}</title>"
+                f"<m:properties><d:Id>{m.group(1)}</d:Id><d:Name>{name}</d:Name>"
+                f"<d:Checksum><d:Algorithm>MD5</d:Algorithm>"
+                f"<d:Value>{hashlib.md5(name.encode()).hexdigest()}</d:Value></d:Checksum>"
+                f"</m:properties></entry>"
+            ).encode()
+            self.reply(200, body, "application/atom+xml")
+        elif rest == "/Nodes":
+            body = (
+                f"<feed {ATOM_NS}><entry><id>{m.group(1)}/Nodes('{node}')</id>"
+                f"<title>{node}</title><m:properties><d:Id>{node}</d:Id>"
+                f"<d:Name>{node}</d:Name></m:properties></entry></feed>"
+            ).encode()
+            self.reply(200, body, "application/atom+xml")
+        elif rest.endswith("/Nodes('manifest.safe')/$value"):
+            self.reply(
+                200, lt_manifest(node), "application/xml", {"ETag": f'"{node}-m"'}
+            )
+        elif rest.endswith("/$value"):
+            self.payload(node, rest)
+        else:
+            self.reply(404, b"not found", "text/plain")
+
+    def payload(self, node, rest):
+        body = lt_payload(LT_OPTS["file_size"] * 1024)
+        if self.command == "GET" and random.random() < LT_OPTS["corrupt_rate"]:
+            lt_count("dhus_corrupt")
+            body = bytes([body[0] ^ 0xFF]) + body[1:]
+        etag = '"' + hashlib.md5((node + rest).encode()).hexdigest() + '"'
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        if self.headers.get("If-None-Match") == etag:
+            self.reply(304, headers=headers)
+            return
+        rng = self.headers.get("Range")
+        if rng and rng.startswith("bytes="):
+            first, _, last = rng[6:].partition("-")
+            first = int(first)
+            last = int(last) if last else len(body) - 1
+            headers["Content-Range"] = f"bytes {first}-{last}/{len(body)}"
+            end = last + 1
+            body = body[first:end]
+            lt_count("dhus_bytes", len(body) if self.command == "GET" else 0)
+            self.reply(206, body, "application/octet-stream", headers)
+            return
+        lt_count("dhus_bytes", len(body) if self.command == "GET" else 0)
+        self.reply(200, body, "application/octet-stream", headers)
+
+
+class RestoHandler(Handler):
+    ITEMS = {}  # featureId -> collection
+
+    def do_POST(self):
+        if LT_OPTS["latency"]:
+            time.sleep(LT_OPTS["latency"])
+        lt_count("resto")
+        doc = json.loads(self.read_body())
+        feats = doc["features"] if doc.get("type") == "FeatureCollection" else [doc]
+        col = self.path.split("/")[2]
+        res = []
+        for feat in feats:
+            fid = str(uuid.uuid5(uuid.NAMESPACE_URL, col + feat["id"]))
+            with LT_LOCK:
+                self.ITEMS[fid] = col
+            res.append({"featureId": fid, "productIdentifier": feat["id"]})
+        body = {
+            "status": "success",
+            "message": "Inserted features",
+            "inserted": len(res),
+            "inError": 0,
+            "features": res,
+            "errors": [],
+        }
+        self.reply(200, json.dumps(body).encode(), "application/json")
+
+    def do_GET(self):
+        if LT_OPTS["latency"]:
+            time.sleep(LT_OPTS["latency"])
+        lt_count("resto")
+        url = urlsplit(self.path)
+        if url.path != "/search":
+            self.reply(404, b"{}", "application/json")
+            return
+        qs = parse_qs(url.query)
+        ids = qs.get("ids", [""])[0].split(",")
+        with LT_LOCK:
+            feats = [{"id": fid, "type": "Feature"} for fid in ids if fid in self.ITEMS]
+        body = {"type": "FeatureCollection", "features": feats}
+        self.reply(200, json.dumps(body).encode(), "application/geo+json")
+
+
+def lt_serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_rs(fdir):
+    # the stac pool pickles its functions by module name, the workers import
+    # register_stac from fdir on the sys.path they get from the parent,
+    # main() is behind the __main__ guard
+    os.symlink(RS_FNAME, os.path.join(fdir, "register_stac.py"))
+    return importlib.import_module("register_stac")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def lt_ini(fdir, dhus, resto):
+    with open(os.path.join(fdir, "dhus.ini"), "w") as f:
+        f.write(
+            f"[source]\nurl = http://127.0.0.1:{dhus.server_port}\n"
+            "username = load\npassword = test\n\n"
+            f"[target]\nurl = http://127.0.0.1:{resto.server_port}\n"
+            f"username = load\npassword = test\nupload_batch = {LT_OPTS['upload_batch']}\n\n"
+            f"[stac]\nbackend = inproc\nworkers = {LT_OPTS['workers']}\n"
+            "s1 = loadtest_stac\ns2 = loadtest_stac\ns3 = loadtest_stac\ns5 = loadtest_stac\n\n"
+            "[http]\nretries = 5\nbackoff_factor = 0.01\n\n"
+            "[log]\nlevel = WARNING\n"
+        )
+
+
+def lt_report(rs, results, wall):
+    ok = [x for x in results if x["code"] == rs.P_EXIT_SUCESS]
+    dl = sum(v for (name, _), v in rs.METRICS.items() if name == "download_bytes_total")
+    print(
+        f"[ products         ][ {len(results)} run, {len(ok)} ok, {len(results) - len(ok)} failed ]"
+    )
+    print(f"[ wall             ][ {wall:.1f} s ]")
+    print(f"[ throughput       ][ {len(ok) / wall * 60:.1f} products/min ]")
+    print(f"[ download         ][ {dl / 2**20:.1f} MB, {dl / wall / 2**20:.2f} MB/s ]")
+    print(
+        f"[ dhus             ][ {LT_STATS['dhus']} requests, {LT_STATS['dhus_err']} answered 503,"
+        f" {LT_STATS['dhus_corrupt']} corrupt ]"
+    )
+    for (name, labels), value in sorted(rs.METRICS.items()):
+        if name == "checksum_total":
+            print(f"[ checksum         ][ {dict(labels).get('result')} {value} ]")
+    print(f"[ resto            ][ {LT_STATS['resto']} requests ]")
+    stages = {}
+    for x in results:
+        for stage, secs in x.get("stages", {}).items():
+            stages.setdefault(stage, []).append(secs)
+    stages["product"] = [x["seconds"] for x in results]
+    for stage, secs in stages.items():
+        print(
+            f"[ {stage:16} ][ p50 {percentile(secs, 50) * 1000:9.1f} ms ]"
+            f"[ p95 {percentile(secs, 95) * 1000:9.1f} ms ]"
+        )
+    for name in ("upload_seconds", "verify_seconds"):
+        total = [v for (key, _), v in rs.METRICS.items() if key == name]
+        count = sum(v[2] for v in total)
+        if count:
+            mean = sum(v[1] for v in total) / count
+            print(f"[ {name[:-8]:16} ][ {count} requests, mean {mean * 1000:.1f} ms ]")
+    for x in results:
+        if x["code"] != rs.P_EXIT_SUCESS:
+            print(
+                f"[ failed           ][ {x['id']} code {x['code']} {x.get('error')} ]"
+            )
+
+
+def main():
+    opts, _ = getopt.getopt(
+        sys.argv[1:],
+        "n:w:",
+        [
+            "files=",
+            "file-size=",
+            "latency=",
+            "bandwidth=",
+            "error-rate=",
+            "corrupt-rate=",
+            "upload-batch=",
+            "keep",
+        ],
+    )
+    for opt, val in opts:
+        if opt == "-n":
+            LT_OPTS["n"] = int(val)
+        elif opt == "-w":
+            LT_OPTS["workers"] = int(val)
+        elif opt == "--files":
+            LT_OPTS["files"] = max(2, int(val))
+        elif opt == "--file-size":
+            LT_OPTS["file_size"] = int(val)
+        elif opt == "--latency":
+            LT_OPTS["latency"] = float(val) / 1000
+        elif opt == "--bandwidth":
+            LT_OPTS["bandwidth"] = float(val)
+        elif opt == "--error-rate":
+            LT_OPTS["error_rate"] = float(val)
+        elif opt == "--corrupt-rate":
+            LT_OPTS["corrupt_rate"] = float(val)
+        elif opt == "--upload-batch":
+            LT_OPTS["upload_batch"] = int(val)
+        elif opt == "--keep":
+            LT_OPTS["keep"] = True
+    for idx in range(LT_OPTS["n"]):
+        LT_PRODUCTS[str(uuid.uuid4())] = (
+            f"S2A_MSIL2A_20230101T{idx:06d}_N0509_R022_T33UVR_20230101T120000"
+        )
+    tmp = tempfile.mkdtemp(prefix="register-stac-loadtest-")
+    with open(os.path.join(tmp, "loadtest_stac.py"), "w") as f:
+        f.write(FAKE_STAC)
+    sys.path.insert(0, tmp)
+    dhus = lt_serve(DhusHandler)
+    resto = lt_serve(RestoHandler)
+    lt_ini(tmp, dhus, resto)
+    try:
+        rs = load_rs(tmp)
+        rs.RUNTIME_DIR = tmp
+        rs.FDIR_OUT = os.path.join(tmp, "out") + os.sep
+        os.makedirs(rs.FDIR_OUT)
+        rs.log_setup({"level": "WARNING"})
+        config = rs.read_ini()
+        started = time.monotonic()
+        results = rs.register_batch(config, list(LT_PRODUCTS))
+        lt_report(rs, results, time.monotonic() - started)
+    finally:
+        dhus.shutdown()
+        resto.shutdown()
+        if LT_OPTS["keep"]:
+            print(f"[ kept             ][ {tmp} ]")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,24 @@
 # coding: utf-8
 
 # IMPORTS
-import bs4 as bs
+import atexit
 import configparser
+import cProfile
 import datetime
+import fcntl
 import getopt
+import hashlib
+import http.server
+import importlib
 import inspect
+import io
 import json
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from os import listdir, sep  # , path
 from pathlib import Path
 import re
@@ -16,17 +27,23 @@ import requests
 from requests.adapters import HTTPAdapter, Retry
 from requests.auth import HTTPBasicAuth
 import shutil
+import signal
+import sqlite3
 import subprocess
 import sys
-import traceback
+import threading
+import time
+import tracemalloc
+from urllib.parse import urlsplit
+import xml.etree.ElementTree as ET
 
 
 PROGRAM_HEADER = """
 
 VERSION: 0.0.1p
 
-Last Update: 20231130
-Last Change: S5P download chunk size experiments, tests
+Last Update: 20261018
+Last Change: harvest watermark kept below a timestamp with products not done
 
 Changes:
 20230801 Initial version
@@ -53,11 +70,52 @@ Changes:
 20231119 align to coding standard advisor
 20231128 S5P verify upload O.K. [ continuous download, S5P manifest ]
 20231130 S5P download chunk size experiments, tests
+20261018 streaming download to disk, small json/xml kept in memory
+20261018 segmented http range download of large products
+20261018 resumable downloads [ .part files, sidecar state, stall watchdog ]
+20261018 one pooled keep-alive http client per host [ dhus.ini http section ]
+20261018 concurrent metadata file download [ metadata_workers ]
+20261018 http cache index, conditional requests replace the size probe
+20261018 disk budgeted product cache, lru eviction, pinning [ cache section ]
+20261018 batch mode [ many ids, -f file or -f - stdin, result summary ]
+20261018 incremental odata harvester with persisted watermark [ -H ]
+20261018 asyncio network engine, sync api calls are thin wrappers over it
+20261018 network thread pool replaces the asyncio engine, single calls run in place
+20261018 stactools called in-process, stac cli subprocess as the fallback
+20261018 stac items generated in a process pool, staging overlaps with it
+20261018 manifest and atom feeds parsed by a streaming parser, no bs4
+20261018 product model: entry, Nodes and manifest fetched and parsed once
+20261018 collection router: rules from [collections] compiled into one regex
+20261018 items uploaded to resto in FeatureCollections per collection
+20261018 uploads verified in batches by the search ids filter, asynchronously
+20261018 plog over the logging module: levels, [log] json and queue modes
+20261018 prometheus metrics per stage, [metrics] textfile or /metrics endpoint
+20261018 --profile cProfile and --trace-malloc tracemalloc per product stage
+20261018 loadtest.py against local dhus and resto, [source] / [target] url
+         may carry the scheme, [stac] s1..s5 create_item modules
+20261018 md5 hashed while the download streams, checked against the manifest
+         MD5, cached files by os.stat and the stored md5, fverify removed
+20261018 per product fcntl.flock in FDIR_OUT/.locks, register-stac.lock
+         removed, instances share FDIR_OUT, cache pins are flocks
+20261018 sqlite job state [ stage, timings, bytes, featureId, error ] per
+         product, resume from the last completed stage, --force
+20261018 -D daemon: *.ids spool files, warm http and stac pools, graceful
+         SIGTERM
 
 Description:
 
 DHR1 TO RESTO REWRITTEN: register-stac.sh from DHusTools
 
+Usage:
+
+./register-stac.py PRODUCT_ID [ PRODUCT_ID ... ]
+./register-stac.py -f ids.txt       # one id per line, -f - reads stdin
+./register-stac.py -H               # harvest new products, dhus.ini [harvest]
+./register-stac.py -D               # daemon, ids from FDIR_OUT/spool/*.ids, SIGTERM stops
+./register-stac.py --profile ID     # FDIR_OUT/profile/ID_stage.pstats
+./register-stac.py --trace-malloc ID  # peak memory per stage, snapshots
+./register-stac.py --force ID       # register again, no resume from FDIR_OUT/register-stac.db
+
 Prereqs:
 
 TBD: $ black register-stac.py && flake8 --max-line-length 100
@@ -73,11 +131,78 @@ TBD:
 
 # USE CACHE
 USE_CACHE=True
+# HTTP CACHE INDEX [ fout.http.json: url, etag, last-modified, size, mtime, md5 of fout ]
+HTTP_CACHE_SUFFIX = ".http.json"
+# CHECKSUMS [ md5 hashed while the download streams, checked against the MD5
+# DHuS publishes in the manifest, dhus.ini [http] checksum ]
+CHECKSUM_VERIFY = True
+# PRODUCT CACHE [ product directories in FDIR_OUT, dhus.ini [cache] ]
+CACHE_BUDGET = 0  # bytes, 0 = unlimited
+CACHE_MAX_AGE = 0  # seconds since last use, 0 = unlimited
+CACHE_PURGE_VERIFIED = False  # drop the product directory after upload verify
+CACHE_PIN_FNAME = ".register-stac.pin"  # in-flight product marker
+CACHE_PRODUCT_RE = re.compile(r"^S[1-6][A-DP_]_")  # only these dirs are evicted
 DOWNLOAD_CHUNK_SIZE=100000000 # size of 1 chunk to download 100000000 = 100 MB
 
+# STREAMING DOWNLOAD [ large or binary responses are written straight to disk ]
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1 MB read from the socket at once
+STREAM_MEM_MAX = 16 * 1024 * 1024  # 16 MB max response kept in memory
+STREAM_MEM_TYPES = ("json", "xml", "text")  # Content-Type kept in memory
+DOWNLOAD_PROGRESS_STEP = 64 * 1024 * 1024  # progress log every 64 MB
+
+# SEGMENTED DOWNLOAD [ parallel HTTP Range requests for large products ]
+DOWNLOAD_SEGMENTS = 4  # parallel connections per file, 1 disables
+DOWNLOAD_SEGMENT_MIN = 64 * 1024 * 1024  # smaller files use one stream
+DISK_FREE_RESERVE = 1024 * 1024 * 1024  # keep 1 GB free on FDIR_OUT
+
+# RESUMABLE DOWNLOAD [ fout.part + fout.part.json sidecar, stall watchdog ]
+DOWNLOAD_PART_SUFFIX = ".part"
+DOWNLOAD_STALL_TIMEOUT = 60  # abort a stream without any data for 60 s
+DOWNLOAD_RESUME_RETRIES = 5  # resume attempts after a drop or a stall
+DOWNLOAD_RESUME_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
 # CHANGE HERE DOWNLOAD DATA DIRECTORY
 FDIR_OUT = "/home/user/dev/work/tmp/"
-FNAME_LOCK = "register-stac.lock"
+# 20261018 PRODUCT LOCKS [ fcntl.flock per product uuid, instead of the one
+# register-stac.lock per FDIR_OUT, the kernel releases them with the process ]
+LOCK_DIR = ".locks"
+PRODUCT_LOCKS = {}  # product uuid -> open lock file
+UPLOAD_FNAME = "resto-{}_upload.json"  # patched item of the product
+VERIFY_FNAME = "resto-{}_verify.json"  # upload result of the verified product
+# 20261018 JOB STATE [ sqlite in FDIR_OUT, dhus.ini [state] ] the last stage a
+# product completed, a new run resumes there, verified ones are skipped
+STATE_FNAME = "register-stac.db"  # empty disables the store
+STATE_STAGES = ("staged", "item", "published", "uploaded", "verified")
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,  -- product uuid
+    name TEXT,
+    stage TEXT,  -- last completed of STATE_STAGES
+    code INTEGER,  -- exit code of the last run
+    error TEXT,
+    feature_id TEXT,
+    verified INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER,  -- staged product directory size
+    seconds REAL,  -- last run
+    stages TEXT,  -- json, seconds per stage of the last run
+    product TEXT,  -- json of the staged Product
+    item TEXT,  -- stac item file in FDIR_OUT
+    upload TEXT,  -- json upload result of the item
+    updated TEXT
+)
+"""
+STATE_DB = None
+STATE_LOCK = threading.Lock()
+STATE_VERIFIED = set()  # product uuids verified when the store was opened
+# 20261018 DAEMON [ -D, dhus.ini [daemon] ] product ids from *.ids files in
+# the spool dir [ one id per line, as -f ], the pools stay warm between them
+DAEMON_SPOOL = "spool"  # in FDIR_OUT, failed ids go to spool/failed
+DAEMON_POLL = 5.0  # seconds between the scans of an empty spool
+DAEMON_STOP = threading.Event()  # SIGTERM / SIGINT: no new products
 
 # RUNTIME DIR
 RUNTIME_DIR = os.getcwd()
@@ -85,12 +210,77 @@ RUNTIME_DIR = os.getcwd()
 # DESTINATION COLLECION TEST PREFIX
 DST_COL_TEST_PREFIX = "mp-"
 
+# 20261018 COLLECTION ROUTER [ dhus.ini [collections] collection = pattern ]
+# first matching rule wins, a pattern matches from the start of the title
+COL_RULES = [
+    ["S1[A-DP]_.._GRD[HM]_", "sentinel-1-grd"],
+    ["S1[A-DP]_.._SLC__", "sentinel-1-slc"],
+    ["S1[A-DP]_.._RAW__", "sentinel-1-raw"],
+    ["S1[A-DP]_.._OCN__", "sentinel-1-ocn"],
+    ["S2[A-DP]_MSIL1B_", "sentinel-2-l1b"],
+    ["S2[A-DP]_MSIL1C_", "sentinel-2-l1c"],
+    ["S2[A-DP]_MSIL2A_", "sentinel-2-l2a"],
+    ["S3[A-DP]_OL_1_", "sentinel-3-olci-l1b"],
+    ["S3[A-DP]_OL_2_", "sentinel-3-olci-l2"],
+    ["S3[A-DP]_SL_1_", "sentinel-3-slstr-l1b"],
+    ["S3[A-DP]_SL_2_", "sentinel-3-slstr-l2"],
+    ["S3[A-DP]_SR_1_", "sentinel-3-stm-l1"],
+    ["S3[A-DP]_SR_2_", "sentinel-3-stm-l2"],
+    ["S3[A-DP]_SY_1_", "sentinel-3-syn-l1"],
+    ["S3[A-DP]_SY_2_", "sentinel-3-syn-l2"],
+    ["S5[A-DP]_OFFL_L1_", "sentinel-5p-l1"],
+    ["S5[A-DP]_NRTI_L1_", "sentinel-5p-l1"],
+    ["S5[A-DP]_OFFL_L2_", "sentinel-5p-l2"],
+    ["S5[A-DP]_NRTI_L2_", "sentinel-5p-l2"],
+]
+COL_ROUTER = None  # ( compiled alternation, collection per rule group )
+
+# 20261018 BULK UPLOAD [ dhus.ini [target] upload_batch ]
+UPLOAD_BATCH = 50  # items per FeatureCollection POST, 1 for one by one
+VERIFY_BATCH = 100  # featureIds per search request
+VERIFY_MISSING_FNAME = "register-stac_missing_{}.txt"  # ids to requeue, -f
+
 # PLOG MSG TYPES
 MTRACE = 3
 MDEBUG = 2
 MINFO = 1
 MWARNING = 0
 
+# 20261018 LOGGING [ dhus.ini [log] level, format, queue, file ]
+# plog priority to the logging level, the disabled levels cost one int check
+LOG = logging.getLogger("register-stac")
+LOG_TRACE = 5
+LOG_LEVELS = {
+    MTRACE: LOG_TRACE,
+    MDEBUG: logging.DEBUG,
+    MINFO: logging.INFO,
+    MWARNING: logging.WARNING,
+}
+LOG_OPTS = {"level": "INFO", "format": "text", "queue": False, "file": None}
+LOG_TEXT_FORMAT = "[%(asctime)s][%(levelname)s][%(funcName)s][%(lineno)d]: %(message)s"
+LOG_LISTENER = None  # QueueListener of the queue mode
+logging.addLevelName(LOG_TRACE, "TRACE")
+
+# 20261018 METRICS [ dhus.ini [metrics] textfile, port, addr ]
+# prometheus text format, the counters and histograms of this process
+METRICS_PREFIX = "register_stac_"
+METRICS_DEF = {
+    "download_bytes_total": ("counter", "Bytes downloaded from the source"),
+    "http_request_seconds": ("histogram", "HTTP response latency per host and status"),
+    "stac_item_seconds": ("histogram", "STAC item generation time per platform"),
+    "upload_seconds": ("histogram", "Bulk item upload latency per collection"),
+    "verify_seconds": ("histogram", "Upload verification latency per collection"),
+    "cache_requests_total": ("counter", "Cached file lookups by result hit or miss"),
+    "checksum_total": ("counter", "Checksum checks of downloaded files by result"),
+    "products_total": ("counter", "Products registered by exit code"),
+}
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+METRICS = {}  # ( name, labels ): counter value or [ bucket counts, sum, count ]
+METRICS_LOCK = threading.Lock()
+METRICS_TEXTFILE = None  # node exporter textfile collector file
+METRICS_PORT = 0  # /metrics endpoint in the batch and harvest modes, 0 off
+METRICS_ADDR = "127.0.0.1"
+
 # INPUT: dhr1 xml files processed by stac tools uploaded to resto catalog
 DEBUG = MTRACE  # debug level 3 brings tracebacks, 2 additional messages
 
@@ -101,11 +291,53 @@ DOWNLOAD_SWAP_FNAME = "tmp_register_stac.swap"
 # PROGRAM EXITS VALUES
 P_EXIT_SUCESS = 0
 P_EXIT_FAILURE = 1
+P_EXIT_LOCKED = 2  # 20261018 the product is registered by another instance
+# BATCH MODE [ osexit inside a product ends the product, not the process ]
+IN_PRODUCT = False
+BATCH_SUMMARY_FNAME = "register-stac_batch_{}.json"
+CMD_OPTS = {}  # command line options
+
+# 20261018 PROFILING [ --profile, --trace-malloc ]
+PROFILE = False  # cProfile of each product stage to PROFILE_DIR
+TRACE_MALLOC = False  # tracemalloc peak and snapshot of each product stage
+PROFILE_DIR = "profile"  # in FDIR_OUT
+# HARVEST [ new products listed from the source odata, dhus.ini [harvest] ]
+HARVEST_STATE_FNAME = "register-stac_harvest.json"  # persisted watermarks
+HARVEST_PAGE_SIZE = 100
+
+# STAC TOOLS [ dhus.ini [stac] backend = inproc | subprocess ]
+STAC_BACKEND = "inproc"  # create_item called in this process, cli fallback
+STAC_BIN = "/usr/local/bin/stac"  # stac cli for the subprocess backend
+STAC_CREATE_ITEM = {
+    "S1": "stactools.sentinel1.grd.stac",
+    "S2": "stactools.sentinel2.stac",
+    "S3": "stactools.sentinel3.stac",
+    "S5": "stactools.sentinel5p.stac",
+}
+STAC_WORKERS = os.cpu_count() or 1  # item processes, 0 runs them in main
+STAC_POOL = None  # ProcessPoolExecutor, warm workers with stactools loaded
+STAC_INFLIGHT = 2  # staged products waiting per worker before publishing
 
 # DOWNLOAD TIMEOUT
 # DOWNLOAD_TIMEOUT = 4096
 DOWNLOAD_TIMEOUT = 100
 
+# HTTP CLIENT [ one pooled keep-alive session per host, dhus.ini [http] ]
+HTTP_POOL_SIZE = 16  # kept alive connections per host
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.1
+HTTP_RETRY_STATUS = [500, 502, 503, 504]
+HTTP_CLIENTS = {}  # hostname -> requests.Session
+HTTP_CLIENTS_LOCK = threading.Lock()
+CACHE_PINNED = {}  # product directory -> pin file held by this process
+CACHE_SIZES = {}  # product directory path -> ( st_mtime_ns, bytes )
+METADATA_WORKERS = 8  # concurrent metadata file downloads per product
+# NETWORK POOL [ threads for the requests which overlap, requests in flight
+# are bounded per host by HTTP_POOL_SIZE and in total by NET_WORKERS ]
+NET_WORKERS = 64
+NET_POOL = None
+NET_SEMAPHORES = {}  # hostname -> threading.BoundedSemaphore
+
 
 def patch_fdir(FDIR):
     global FDIR_OUT
@@ -118,42 +350,73 @@ def patch_fdir(FDIR):
     return FDIR
 
 
+# 20261018 target path of a downloaded file, same layout as fwrite
+def fpath_out(pfile, FDIR=None):
+    FDIR = patch_fdir(FDIR)
+    Path(FDIR).mkdir(parents=True, exist_ok=True)
+    return FDIR + pfile.split(os.sep)[-1]
+
+
+# 20261018 STREAMING XML
+# iterparse [ expat ] yields the elements with the local name in tags,
+# namespaces ignored, everything outside them is dropped from the tree as
+# soon as it ends, the memory stays flat for any manifest size
+# src: file path or the xml as str / bytes
+def xml_iter(src, tags):
+    if isinstance(src, str) and src.lstrip()[:1] == "<":
+        src = src.encode()
+    if isinstance(src, (bytes, bytearray)):
+        src = io.BytesIO(src)
+    stack = []
+    depth = 0  # open elements from tags
+    for event, elem in ET.iterparse(src, events=("start", "end")):
+        wanted = elem.tag.rsplit("}", 1)[-1] in tags
+        if event == "start":
+            stack.append(elem)
+            depth += wanted
+            continue
+        stack.pop()
+        if wanted:
+            depth -= 1
+            yield elem
+        if depth == 0:
+            elem.clear()
+            if stack and len(stack[-1]) and stack[-1][-1] is elem:
+                del stack[-1][-1]
+
+
+# text of the first descendant with the local name, None when missing
+def xml_text(elem, name):
+    for child in elem.iter():
+        if child.tag.rsplit("}", 1)[-1] == name:
+            return child.text or ""
+    return None
+
+
 # REQ 20230801002 Obtains metadata for the given product from DHuS storage | 003
 # read node.xml
 def fread(pfile, FDIR=None):
     FDIR = patch_fdir(FDIR)
     with open(FDIR + pfile, "rb") as f:
       txt = f.read()
-    plog(f"[*][ fread FDIR: {FDIR} pfile: {pfile}")
+    plog(f"[*][ fread FDIR: {FDIR} pfile: {pfile}", MDEBUG)
     return txt
 
 
-def fverify(pfile, sz=None, FDIR=None):
-    tmp = 0
-    ret = None
-    #FDIR = patch_fdir(FDIR)
-    os.chdir(FDIR)
-    try:
-        with open(pfile, "r") as f:
-          tmp = len(f.read())
-          plog(
-              f"[+][ File {pfile} verify as txt o.k., size: {str(tmp)} b expected: {str(sz)}]"
-          )
-        # ret = True
-    except Exception as e:
-        plog(f"[!][ File {pfile} Verify as txt not o.k. {str(e)}]")
-        try:
-            with open(pfile, "rb") as f:
-              tmp = len(f.read())
-              plog(f"[+][ File {pfile} verify as bin o.k., size: {str(tmp)} b]")
-            # ret = True
-        except Exception as et:
-            plog(f"[!][ File {pfile} Verify not o.k. {str(et)}]")
-            ret = False
-    if sz == tmp:
-        plog(f"[*][ File {pfile} sizes equals ]")
-        ret = True
-    return ret
+# 20261018 md5 of a file in one sequential read [ upto bytes ], for the
+# downloads not hashed while streaming [ segmented, resumed from an older run ]
+def file_md5(fname, upto=None):
+    md5 = hashlib.md5()
+    left = upto
+    with open(fname, "rb") as f:
+        while left is None or left > 0:
+            chunk = f.read(STREAM_CHUNK_SIZE if left is None else min(left, STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            md5.update(chunk)
+            if left is not None:
+                left -= len(chunk)
+    return md5
 
 
 # REQ 20230801002 Obtains metadata for the given product from DHuS storage | 002
@@ -163,27 +426,30 @@ def fwrite(pfile, txt, FDIR=None):
     # if fverify(pfile, len(txt), "./"):  # 20231116 # clobber off
     #  return 0
     try:
-        plog(f"[*] event: fwrite created directory {FDIR}")
+        plog(f"[*] event: fwrite created directory {FDIR}", MTRACE)
         newdir = Path(FDIR)
         # if not newdir.exists():
         newdir.mkdir(parents=True, exist_ok=True)  # 20231019
     except Exception as e:
         plog(f"[!] warning: fwrite create directory {str(e)} {FDIR}")
     try:
-        os.chdir(FDIR)
-        fpfile = pfile
-        if os.sep in pfile:
-            fpfile = pfile.split(os.sep)[-1]
+        # 20261018 absolute path, no chdir, written as tmp then renamed
+        # so concurrent writers never see a half written file
+        fpfile = FDIR + pfile.split(os.sep)[-1]
+        ftmp = f"{fpfile}.{os.getpid()}.{threading.get_ident()}.tmp"
         if isinstance(txt, bytes):
-            with open(fpfile, "wb") as f:
-              f.write(txt)
+            with open(ftmp, "wb") as f:
+              wsz = f.write(txt)
         else:
-            with open(fpfile, "w") as f:
-              f.write(txt)
+            with open(ftmp, "w") as f:
+              wsz = f.write(txt)
+        # 20261018 the written count replaces fverify, no read back
+        if wsz != len(txt):
+            raise OSError(f"short write {wsz} of {len(txt)}")
+        os.replace(ftmp, fpfile)
         plog(
           f"[F] written : FDIR: {FDIR} FILE: {pfile} BIN: {str(isinstance(txt, bytes))}"
         )
-        fverify(fpfile, len(txt),FDIR)  # 20231116
     except Exception as e:
         plog(f"[*] error: fwrite cannot write {pfile} in {FDIR}")
         plog(f"[*] BIN: {str(isinstance(txt, bytes))} error: {str(e)}")
@@ -196,7 +462,7 @@ def fexists(file):
     if FDIR_OUT[-1]!=os.sep:
        file=os.sep+file
     str_fname = FDIR_OUT + file
-    print(str_fname)
+    plog(str_fname, MDEBUG)
     ret = Path(str_fname).is_file()
     return int(ret)
 
@@ -212,23 +478,195 @@ def __LINE__() -> int:
     return inspect.currentframe().f_back.f_lineno
 
 
-# using datetime module
-def plog(message, message_priority=1):
-    if message_priority > 0 or DEBUG == 1:
-        cdt = datetime.datetime.now()
-        print(
-            "["
-            + str(cdt)
-            + "]["
-            + str(message_priority)
-            + "]["
-            + inspect.stack()[1].function
-            + "]["
-            + str(inspect.stack()[1].lineno)
-            + "]: "
-            + str(message),
-            flush=True,
-        )
+# 20261018 logging module: the caller is the frame above plog [ stacklevel ],
+# no inspect.stack, the message is formatted only when the level is enabled
+def plog(message, message_priority=MINFO):
+    level = LOG_LEVELS.get(message_priority, logging.INFO)
+    if LOG.isEnabledFor(level):
+        LOG.log(level, message, stacklevel=2)
+
+
+# one json object per line
+class LogJsonFormatter(logging.Formatter):
+    def format(self, record):
+        doc = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "func": record.funcName,
+            "line": record.lineno,
+            "pid": record.process,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc)
+
+
+# the handlers from LOG_OPTS, in the queue mode the records are written by
+# a listener thread and the callers only put them in the queue
+def log_setup(opts=None):
+    global LOG_LISTENER
+    if opts:
+        LOG_OPTS.update(opts)
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER = None
+    if LOG_OPTS["file"]:
+        handler = logging.FileHandler(LOG_OPTS["file"])
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    if LOG_OPTS["format"] == "json":
+        handler.setFormatter(LogJsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+    if LOG_OPTS["queue"]:
+        LOG_LISTENER = logging.handlers.QueueListener(queue.SimpleQueue(), handler)
+        LOG_LISTENER.start()
+        handler = logging.handlers.QueueHandler(LOG_LISTENER.queue)
+    for old in list(LOG.handlers):
+        LOG.removeHandler(old)
+    LOG.addHandler(handler)
+    LOG.setLevel(logging.getLevelName(str(LOG_OPTS["level"]).upper()))
+    LOG.propagate = False
+
+
+def log_shutdown():
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()  # writes the queued records
+        LOG_LISTENER = None
+
+
+atexit.register(log_shutdown)
+
+
+# 20261018 METRICS
+def metric_inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        METRICS[key] = METRICS.get(key, 0) + value
+
+
+def metric_observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        hist = METRICS.get(key)
+        if hist is None:
+            hist = METRICS[key] = [[0] * len(METRICS_BUCKETS), 0.0, 0]
+        for idx, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                hist[0][idx] += 1
+        hist[1] += value
+        hist[2] += 1
+
+
+def metrics_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def metrics_text():
+    with METRICS_LOCK:
+        items = [
+            (k, [list(v[0]), v[1], v[2]] if isinstance(v, list) else v)
+            for k, v in METRICS.items()
+        ]
+    items.sort(key=lambda x: (x[0][0], str(x[0][1])))
+    lines = []
+    for name, (mtype, mhelp) in METRICS_DEF.items():
+        full = METRICS_PREFIX + name
+        lines.append(f"# HELP {full} {mhelp}")
+        lines.append(f"# TYPE {full} {mtype}")
+        for (key, labels), value in items:
+            if key != name:
+                continue
+            if mtype == "counter":
+                lines.append(f"{full}{metrics_labels(labels)} {value}")
+                continue
+            for bound, count in zip(METRICS_BUCKETS, value[0]):
+                lines.append(f"{full}_bucket{metrics_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{full}_bucket{metrics_labels(labels, [('le', '+Inf')])} {value[2]}")
+            lines.append(f"{full}_sum{metrics_labels(labels)} {value[1]}")
+            lines.append(f"{full}_count{metrics_labels(labels)} {value[2]}")
+    return "\n".join(lines) + "\n"
+
+
+# written as tmp then renamed, the collector never reads a partial file
+def metrics_write():
+    if not METRICS_TEXTFILE:
+        return
+    try:
+        ftmp = f"{METRICS_TEXTFILE}.{os.getpid()}.tmp"
+        with open(ftmp, "w") as f:
+            f.write(metrics_text())
+        os.replace(ftmp, METRICS_TEXTFILE)
+    except OSError as e:
+        exc_handl(e, f"[!][ metrics textfile {METRICS_TEXTFILE} not written ]")
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        plog("[M] " + format % args, MDEBUG)
+
+
+def metrics_serve():
+    server = http.server.ThreadingHTTPServer((METRICS_ADDR, METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    plog(f"[*][ metrics at http://{METRICS_ADDR}:{METRICS_PORT}/metrics ]")
+    return server
+
+
+# optional [metrics] section
+def metrics_setup(config):
+    global METRICS_TEXTFILE, METRICS_PORT, METRICS_ADDR
+    if "metrics" not in config:
+        return
+    METRICS_TEXTFILE = config["metrics"].get("textfile", METRICS_TEXTFILE) or None
+    METRICS_PORT = config["metrics"].getint("port", METRICS_PORT)
+    METRICS_ADDR = config["metrics"].get("addr", METRICS_ADDR)
+    plog(f"[*] CFG METRICS TEXTFILE: {METRICS_TEXTFILE} PORT: {METRICS_PORT}")
+
+
+atexit.register(metrics_write)
+
+
+# response hook of the http clients
+def metrics_response(r, *args, **kwargs):
+    metric_observe(
+        "http_request_seconds",
+        r.elapsed.total_seconds(),
+        host=urlsplit(r.url).hostname,
+        method=r.request.method,
+        status=r.status_code,
+    )
+
+
+# optional [log] section
+def log_config(config):
+    if "log" not in config:
+        return
+    log_setup(
+        {
+            "level": config["log"].get("level", LOG_OPTS["level"]),
+            "format": config["log"].get("format", LOG_OPTS["format"]),
+            "queue": config["log"].getboolean("queue", LOG_OPTS["queue"]),
+            "file": config["log"].get("file", LOG_OPTS["file"]) or None,
+        }
+    )
 
 
 # REQ 20230801003 endpoint specified in configuration - read
@@ -260,6 +698,15 @@ def read_ini():
     # plog(str(config.sections()))
     plog("[*] CFG SOURCE URL: " + config["source"]["url"])
     plog("[*] CFG TARGET URL: " + config["target"]["url"])
+    http_setup(config)  # 20261018
+    cache_setup(config)  # 20261018
+    log_config(config)  # 20261018
+    metrics_setup(config)  # 20261018
+    stac_setup(config)  # 20261018
+    col_router_setup(config)  # 20261018
+    upload_setup(config)  # 20261018
+    state_setup(config)  # 20261018
+    daemon_setup(config)  # 20261018
     # print(config['source']['username'])
     # print(config['source']['password'])
     return config
@@ -269,23 +716,134 @@ def read_ini():
 # config=read_ini()
 
 
+# 20261018 http client settings from the optional [http] section
+def http_setup(config):
+    global HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_BACKOFF, DOWNLOAD_TIMEOUT
+    global DOWNLOAD_STALL_TIMEOUT, DOWNLOAD_SEGMENTS, METADATA_WORKERS, NET_WORKERS
+    global CHECKSUM_VERIFY
+    if "http" not in config:
+        return
+    http = config["http"]
+    HTTP_POOL_SIZE = http.getint("pool_size", HTTP_POOL_SIZE)
+    HTTP_RETRIES = http.getint("retries", HTTP_RETRIES)
+    HTTP_BACKOFF = http.getfloat("backoff_factor", HTTP_BACKOFF)
+    DOWNLOAD_TIMEOUT = http.getint("timeout", DOWNLOAD_TIMEOUT)
+    DOWNLOAD_STALL_TIMEOUT = http.getint("stall_timeout", DOWNLOAD_STALL_TIMEOUT)
+    DOWNLOAD_SEGMENTS = http.getint("segments", DOWNLOAD_SEGMENTS)
+    METADATA_WORKERS = http.getint("metadata_workers", METADATA_WORKERS)
+    NET_WORKERS = http.getint("net_workers", NET_WORKERS)
+    CHECKSUM_VERIFY = http.getboolean("checksum", CHECKSUM_VERIFY)
+    plog(f"[*] CFG HTTP POOL SIZE: {HTTP_POOL_SIZE} RETRIES: {HTTP_RETRIES}")
+
+
+# 20261018 one keep-alive session per host shared by all source and target
+# calls, connections are reused from the pool instead of a new TCP+TLS
+# handshake per request, 5xx answers of idempotent requests are retried
+# 20261018 a dhus.ini url may carry its scheme [ http://127.0.0.1:8080 ],
+# https:// otherwise
+def http_base(hostname):
+    if "://" in hostname:
+        return hostname.rstrip("/")
+    return "https://" + hostname
+
+
+def http_client(hostname):
+    hostname = urlsplit(http_base(hostname)).netloc  # one client per netloc
+    with HTTP_CLIENTS_LOCK:
+        session = HTTP_CLIENTS.get(hostname)
+        if session is None:
+            retries = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=HTTP_RETRY_STATUS,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=retries,
+            )
+            session = requests.Session()
+            session.hooks["response"].append(metrics_response)  # 20261018
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            HTTP_CLIENTS[hostname] = session
+            plog(f"[*][ HTTP client for {hostname} pool size {HTTP_POOL_SIZE} ]")
+    return session
+
+
+def http_client_url(url):
+    return http_client(urlsplit(url).netloc)
+
+
+# 20261018 NETWORK POOL
+# a stage makes its blocking pooled http calls on its own thread, one at a
+# time, no hop to another thread, the requests which overlap [ the metadata
+# files of a product, the verifies behind the uploads ] run on one pool
+def net_pool():
+    global NET_POOL
+    with HTTP_CLIENTS_LOCK:
+        if NET_POOL is None:
+            NET_POOL = ThreadPoolExecutor(
+                max_workers=NET_WORKERS, thread_name_prefix="net"
+            )
+            plog(f"[*][ Network pool started, {NET_WORKERS} workers ]")
+    return NET_POOL
+
+
+# fn(*args) with at most HTTP_POOL_SIZE calls to hostname in flight
+def net_call(hostname, fn, *args, **kwargs):
+    with HTTP_CLIENTS_LOCK:
+        sem = NET_SEMAPHORES.get(hostname)
+        if sem is None:
+            sem = NET_SEMAPHORES[hostname] = threading.BoundedSemaphore(HTTP_POOL_SIZE)
+    with sem:
+        return fn(*args, **kwargs)
+
+
+# fn(*args) for every args of argslist on the pool, at most limit at once,
+# exceptions are returned in place of the results
+def net_map(fn, argslist, limit):
+    sem = threading.Semaphore(max(1, limit))
+    futs = []
+    for args in argslist:
+        sem.acquire()
+        fut = net_pool().submit(fn, *args)
+        fut.add_done_callback(lambda _: sem.release())
+        futs.append(fut)
+    results = []
+    for fut in futs:
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            results.append(e)
+    return results
+
+
 # EXCEPTION HANDLER
 def exc_handl(e, msg, warning=True):
     if e is None:
         e = "Undefined Error"
-    if DEBUG > 2:
-        traceback.print_exc(file=sys.stdout)
     if DEBUG > 1:
-        plog(msg, 2)  # CHANGE HERE
+        # 20261018 the traceback through the logging setup, at debug level only
+        tb = DEBUG > 2 and isinstance(e, BaseException) and LOG.isEnabledFor(logging.DEBUG)
+        LOG.log(LOG_LEVELS[MDEBUG], msg, exc_info=e if tb else None, stacklevel=2)
     if warning:
         if e is not None:
-            plog("[!] Exception message: " + str(e))
+            LOG.warning("[!] Exception message: " + str(e), stacklevel=2)
     return P_EXIT_FAILURE
 
 
+# 20261018 raised by osexit while a product of a batch is registered
+class ProductExit(Exception):
+    def __init__(self, code):
+        super().__init__(f"product exit code {code}")
+        self.code = code
+
+
 def osexit(P_ERR_CODE):
-    rmlock()  # 20231116
-    exit(P_ERR_CODE)
+    if IN_PRODUCT:
+        raise ProductExit(P_ERR_CODE)
+    exit(P_ERR_CODE)  # 20261018 the product flocks go with the process
 
 
 # REQ 20230801003 endpoint specified in configuration - write
@@ -317,20 +875,37 @@ def create_ini():
 # REQ 20230801001 Obtains a product ID from command line attribute - function
 
 
+# 20261018 ids from the command line, from -f file or from stdin (-f -)
+# usage: register-stac.py [ -f FILE|- ] [ ID ... ]
+def read_ids(fname):
+    if fname == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(fname, "r") as f:
+            lines = f.read().splitlines()
+    return [x.strip() for x in lines if x.strip() and not x.startswith("#")]
+
+
 def proc_cmd_opts():
     # global ID
-    ID = None
+    IDS = []
     # https://docs.python.org/3/library/getopt.html
     try:
-        opts, args = getopt.getopt(sys.argv[1:], [])
+        opts, args = getopt.getopt(
+            sys.argv[1:], "f:HD", ["profile", "trace-malloc", "force"]
+        )
         # plog("optlist: "+str(opts))
         # plog("args: "+str(args))
-        # plog(len(args))
-        if len(args) > 0:
-            # plog(args[0])
-            ID = args[0]
-            plog("[I] INPUT ID: " + ID)
-            return ID
+        for opt, val in opts:
+            CMD_OPTS[opt] = val
+            if opt == "-f":
+                IDS += read_ids(val)
+        prof_setup("--profile" in CMD_OPTS, "--trace-malloc" in CMD_OPTS)
+        IDS += args
+        if len(IDS) > 0 or "-H" in CMD_OPTS or "-D" in CMD_OPTS:
+            for ID in IDS:
+                plog("[I] INPUT ID: " + ID)
+            return IDS
         else:
             plog("[ ERR RS-0010 ][!][ NO ARGUMENT SPECIFIED ]")
             osexit(P_EXIT_FAILURE)
@@ -374,19 +949,9 @@ def check_source_id(src_id):
 
 def get_api_large_file(url, basicauth, is_stream):
     local_filename = DOWNLOAD_SWAP_FNAME
-    # NOTE the stream=True parameter below
-    total_size = get_size(url) # total size in bytes
     try:
-        with requests.get(
-            url=url, auth=basicauth, stream=is_stream, timeout=DOWNLOAD_TIMEOUT
-        ) as r:
-            r.raise_for_status()
-            with open(local_filename, "wb") as f:
-                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE,total  = total_size // DOWNLOAD_CHUNK_SIZE):
-                    # If you have chunk encoded response uncomment if
-                    # and set chunk_size parameter to None.
-                    # if chunk:
-                    f.write(chunk)
+        # 20261018 streamed, segmented if the server accepts ranges
+        download_file(url, dict(), basicauth, os.path.abspath(local_filename))
     except Exception as e:
         plog("[!][ Failed to download the file")
         plog("[!][ ERROR: " + str(e))
@@ -417,72 +982,450 @@ def get_download_size(sz, exp_sz):
     if exp_sz != 0:
         pct = int(sz / int(exp_sz) * 100)
         plog(
-            f"[I][{pct:03}][ Download Percent: {pct:03}% ][ {sz:12} b / {exp_sz:12} b ]"
+            f"[I][{pct:03}][ Download Percent: {pct:03}% ][ {sz:12} b / {exp_sz:12} b ]",
+            MDEBUG,
         )
 
 
-def get_progress(cnt, exp_sz):
-    if exp_sz != 0:
-        blocks = int(cnt * 8192)
-        pct = int(blocks / int(exp_sz) * 100)
-        plog(
-            f"[I][{pct:03}][ Download Percent: {pct:03}% ][ {cnt*8192:12} b / {exp_sz:12} b ]"
+# 20261018 decide from the response headers whether to stream to disk
+def download_to_disk(headers, exp_sz):
+    if exp_sz > STREAM_MEM_MAX:
+        return True
+    ctype = headers.get("Content-Type", "").lower()
+    for mtype in STREAM_MEM_TYPES:
+        if mtype in ctype:
+            return False
+    return True
+
+
+# 20261018 HTTP CACHE INDEX
+# revalidation without a body transfer or a local read: the stored ETag /
+# Last-Modified is sent as If-None-Match / If-Modified-Since, 304 keeps the
+# file, os.stat size must match the stored size for the entry to be used
+# 20261018 the entry keeps the md5 hashed during the download and the mtime
+# of the file, a file with the same os.stat has the stored md5
+# 20261018 one entry per file in the fout.http.json sidecar [ like the
+# fout.part.json of a resumable download ]: a lookup or an update reads or
+# rewrites one small file, an evicted product directory takes its entries
+def http_cache_read(fout):
+    try:
+        with open(fout + HTTP_CACHE_SUFFIX, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def http_cache_write(fout, entry):
+    fentry = fout + HTTP_CACHE_SUFFIX
+    ftmp = f"{fentry}.{os.getpid()}.tmp"
+    try:
+        with open(ftmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(ftmp, fentry)
+    except OSError as e:
+        plog(f"[!][ Cannot save http cache entry {fentry} {str(e)} ]")
+
+
+def http_cache_put(url, fout, headers, sz, md5=None):
+    old = http_cache_read(fout) or {}
+    mtime = None  # set by http_cache_stat once the file is in place
+    if md5 is None and old.get("url") == url and old.get("size") == sz:
+        md5 = old.get("md5")  # HEAD revalidation of a hashed file
+        mtime = old.get("mtime")
+    http_cache_write(
+        fout,
+        {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": sz,
+            "mtime": mtime,
+            "md5": md5,
+        },
+    )
+
+
+# the os.stat of fout once it is in place [ renamed or written by the caller ]
+def http_cache_stat(url, fout):
+    entry = http_cache_read(fout)
+    if entry and entry.get("url") == url:
+        try:
+            st = os.stat(fout)
+        except OSError:
+            return
+        entry["size"] = st.st_size
+        entry["mtime"] = st.st_mtime_ns
+        http_cache_write(fout, entry)
+
+
+def http_cache_drop(fout):
+    try:
+        os.remove(fout + HTTP_CACHE_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def http_cache_entry(url, fout):
+    entry = http_cache_read(fout)
+    if not entry or entry.get("url") != url:
+        return None
+    try:
+        st = os.stat(fout)
+    except OSError:
+        return None
+    if st.st_size != entry["size"]:
+        return None
+    if entry.get("mtime") is not None and st.st_mtime_ns != entry["mtime"]:
+        return None  # changed on disk since it was hashed
+    return entry
+
+
+# 20261018 md5 of fout against the md5 DHuS publishes, from the cache entry
+# [ os.stat matches the hashed file ], the file is read only when no digest
+# is stored [ downloaded by an older version ], True when equal or unknown
+def checksum_ok(url, fout, md5):
+    if not CHECKSUM_VERIFY or not md5:
+        return True
+    entry = http_cache_entry(url, fout)
+    digest = entry.get("md5") if entry else None
+    if digest is None:
+        try:
+            digest = file_md5(fout).hexdigest()
+        except OSError:
+            return False
+        if entry:
+            entry["md5"] = digest
+            http_cache_write(fout, entry)
+    if digest.lower() != md5.lower():
+        plog(f"[!][ Checksum mismatch {fout} md5 {digest} expected {md5} ]", MWARNING)
+        metric_inc("checksum_total", result="mismatch")
+        return False
+    metric_inc("checksum_total", result="ok")
+    return True
+
+
+def http_cache_validators(url, fout):
+    headers = {}
+    entry = http_cache_entry(url, fout)
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+# 20261018 files cached without validators are checked by a HEAD request,
+# the Content-Length is compared with os.stat, True when the file is current
+def http_cache_head(url, fout, basicauth):
+    try:
+        fsz = os.stat(fout).st_size
+    except OSError:
+        return False
+    if http_cache_validators(url, fout):
+        return False  # the conditional GET revalidates it
+    r = http_client_url(url).head(
+        url, auth=basicauth, timeout=DOWNLOAD_TIMEOUT, allow_redirects=True
+    )
+    if r.status_code == 200 and int(r.headers.get("Content-Length", -1)) == fsz:
+        http_cache_put(url, fout, r.headers, fsz)
+        return True
+    return False
+
+
+# 20261018 free space check before a large file is written
+def check_disk_free(fout, exp_sz):
+    free = shutil.disk_usage(os.path.dirname(fout) or ".").free
+    if free < exp_sz + DISK_FREE_RESERVE:
+        raise OSError(
+            f"not enough disk space for {fout}: {exp_sz} b needed, {free} b free"
         )
 
 
+# 20261018 range download is possible for identity encoded large files only
+def download_ranges(headers, exp_sz):
+    if DOWNLOAD_SEGMENTS < 2 or exp_sz < DOWNLOAD_SEGMENT_MIN:
+        return False
+    if headers.get("Content-Encoding", "identity") != "identity":
+        return False
+    return headers.get("Accept-Ranges", "").lower() == "bytes"
 
-def download_file(url, params, basicauth):
-    resp = b""
-    cnt = 0
-    new = True
-    exp_sz = 0
-    # try:
 
-    # resp = requests.get(url,auth=basicauth,params=params,timeout=DOWNLOAD_TIMEOUT)
+# 20261018 raised when the server answers a range request with the full body
+class RangeNotHonoured(Exception):
+    pass
+
+
+# 20261018 RESUMABLE DOWNLOAD STATE
+# fout.part holds the bytes received so far, fout.part.json the sidecar:
+# {"url", "etag", "size", "received"} for one stream or
+# {"url", "etag", "size", "segments": [[start, end, received], ...]}
+def part_state_read(fout):
+    try:
+        with open(fout + DOWNLOAD_PART_SUFFIX + ".json", "r") as f:
+            state = json.load(f)
+        if os.path.isfile(fout + DOWNLOAD_PART_SUFFIX):
+            return state
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def part_state_write(fout, state):
+    fstate = fout + DOWNLOAD_PART_SUFFIX + ".json"
+    with open(fstate + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(fstate + ".tmp", fstate)
+
+
+def part_state_clear(fout):
+    for fname in (fout + DOWNLOAD_PART_SUFFIX, fout + DOWNLOAD_PART_SUFFIX + ".json"):
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+
+
+def part_done(fout):
+    os.replace(fout + DOWNLOAD_PART_SUFFIX, fout)
+    part_state_clear(fout)
+
+
+# 20261018 download the rest of one byte range [start, end] at its offset
+# seg is [start, end, received] shared with the sidecar state
+def download_segment(session, url, params, basicauth, fout, seg, state, lock):
+    start, end = seg[0] + seg[2], seg[1]
+    got = seg[2]
+    headers = {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+    if state.get("etag"):
+        headers["If-Range"] = state["etag"]
+    step = 0
+    try:
+        with session.get(
+            url,
+            params=params,
+            auth=basicauth,
+            headers=headers,
+            stream=True,
+            timeout=(DOWNLOAD_TIMEOUT, DOWNLOAD_STALL_TIMEOUT),
+        ) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RangeNotHonoured(
+                    f"range {start}-{end} not honoured, status {r.status_code}"
+                )
+            with open(fout + DOWNLOAD_PART_SUFFIX, "r+b") as f:
+                f.seek(start)
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+                        seg[2] += len(chunk)
+                        step += len(chunk)
+                        if step >= DOWNLOAD_PROGRESS_STEP:
+                            step = 0
+                            f.flush()
+                            with lock:
+                                part_state_write(fout, state)
+    finally:
+        with lock:
+            part_state_write(fout, state)
+        metric_inc("download_bytes_total", seg[2] - got, host=urlsplit(url).hostname)
+    if seg[2] != seg[1] - seg[0] + 1:
+        raise requests.ConnectionError(f"range {start}-{end} short read")
+    plog(f"[*][ Segment {seg[0]}-{seg[1]} done {seg[2]} b ]", MDEBUG)
+    return seg[2]
+
+
+# 20261018 segmented download, DOWNLOAD_SEGMENTS ranges fetched concurrently
+# into a preallocated file, state continues the segments of a former attempt
+def download_file_segmented(
+    session, url, params, basicauth, fout, exp_sz, etag, state
+):
+    if state is None:
+        with open(fout + DOWNLOAD_PART_SUFFIX, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, exp_sz)
+            except (AttributeError, OSError):
+                f.truncate(exp_sz)
+        seg_sz = -(-exp_sz // DOWNLOAD_SEGMENTS)
+        state = {
+            "url": url,
+            "etag": etag,
+            "size": exp_sz,
+            "segments": [
+                [start, min(start + seg_sz, exp_sz) - 1, 0]
+                for start in range(0, exp_sz, seg_sz)
+            ],
+        }
+    segs = [seg for seg in state["segments"] if seg[2] < seg[1] - seg[0] + 1]
+    plog(f"[*][ Segmented download {len(segs)} segments to {fout} ]")
+    lock = threading.Lock()
+    part_state_write(fout, state)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_SEGMENTS) as executor:
+        futures = [
+            executor.submit(
+                download_segment, session, url, params, basicauth, fout, seg, state, lock
+            )
+            for seg in segs
+        ]
+        for future in futures:
+            future.result()
+    get_download_size(sum(seg[2] for seg in state["segments"]), exp_sz)
+    part_done(fout)
+    return Path(fout)
+
+
+# 20261018 streaming download
+# fout=None keeps the response in memory (json/xml api calls), with fout the
+# large or binary responses are written chunk by chunk to fout.part and Path(fout)
+# is returned instead of bytes, responses growing over STREAM_MEM_MAX are spilled
+# a dropped or stalled stream is resumed from the sidecar state of fout.part
+def download_file(url, params, basicauth, fout=None, segmented=True):
+    for attempt in range(DOWNLOAD_RESUME_RETRIES + 1):
+        try:
+            return download_attempt(url, params, basicauth, fout, segmented)
+        except DOWNLOAD_RESUME_ERRORS as e:
+            if fout is None or attempt == DOWNLOAD_RESUME_RETRIES:
+                raise
+            exc_handl(e, f"[!][ Download dropped or stalled, resume {attempt + 1} ]")
+
+
+def download_attempt(url, params, basicauth, fout, segmented):
+    resp = bytearray()
+    sz = 0
+    exp_sz = 0
+    f = None
+    md5 = hashlib.md5()  # 20261018 hashed while streaming
+    use_ranges = False
+    headers = {}
+    state = None
+    if fout:
+        state = part_state_read(fout)
+        if state and state.get("url") != url:
+            state = None
+    if state and state.get("received") and state["received"] == state.get("size"):
+        part_done(fout)  # complete before the former run stopped
+        http_cache_drop(fout)  # not hashed, checksum_ok reads it once
+        return Path(fout)
+    if state and "received" in state:
+        headers["Range"] = f"bytes={state['received']}-"
+        if state.get("etag"):
+            headers["If-Range"] = state["etag"]
+    elif fout and USE_CACHE is True:
+        headers.update(http_cache_validators(url, fout))
     # use requests.get(url, stream=True).headers['Content-length']
-    session=requests.Session()
-    retries = Retry(total=3,backoff_factor=0.1,status_forcelist=[ 500, 502, 503, 504 ])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
-    with session.get(url, params=params, auth=basicauth, stream=True) as r:
+    session = http_client_url(url)  # 20261018 pooled
+    with session.get(
+        url,
+        params=params,
+        auth=basicauth,
+        headers=headers,
+        stream=True,
+        timeout=(DOWNLOAD_TIMEOUT, DOWNLOAD_STALL_TIMEOUT),  # stall watchdog
+    ) as r:
+        r.raise_for_status()  # HERE 20231130
+        if r.status_code == 304:
+            plog(f"[C][ Not modified, cached file kept: {fout} ]")
+            metric_inc("cache_requests_total", result="hit")
+            return Path(fout)
+        if fout and USE_CACHE is True and r.status_code == 200:
+            metric_inc("cache_requests_total", result="miss")
+        plog(r.headers, MTRACE)
+        etag = r.headers.get("ETag")
         try:
-            if new:
-                plog(r.headers)
-                if "Content-Length" in r.headers:
-                    exp_sz = r.headers["Content-Length"]
-                    # iexp_sz=int(int(exp_sz)/1024/1024)
-                    plog(f"[*] Expected download size: {str(exp_sz)} b ]")
-                else:
-                    exp_sz = 0
+            exp_sz = int(r.headers.get("Content-Length", 0))
+            plog(f"[*] Expected download size: {str(exp_sz)} b ]")
         except Exception as e:
             plog(f"[!] error while expected size retrieval {str(e)}")
-        new = False
-        for chunk in r.iter_content(chunk_size=8192):
-            # If you have chunk encoded response uncomment if
-            # and set chunk_size parameter to None.
-            r.raise_for_status()  # HERE 20231130
-            # with open(fname, 'wb') as f:
-            if chunk:
-                if cnt % 1024 == 0:
-                    get_progress(cnt, exp_sz)
-                try:
-                    if not resp:
-                        # resp = chunk.decode("utf-8")  # f.write(chunk) txt
-                        resp = chunk  # f.write(chunk) txt
-                    else:
-                        # resp += chunk.decode("utf-8")  # f.write(chunk) txt
-                        resp += chunk  # f.write(chunk) txt
-                except Exception as e:
-                    if not resp:
-                        resp = chunk  # f.write(chunk) bin
-                    else:
-                        resp += chunk  # f.write(chunk) bin
-                    if cnt % 1000 == 0:
-                        plog(f"[*][{cnt}][ Download chunk .... {str(e)}]")
-                cnt += 1
-    # except Exception as e:
-    #  plog("[*][ NO MORE DATA ON STREAM ]")
-    get_download_size(len(resp), exp_sz)
-    return resp  # .decode("utf-8","replace")
+        if r.status_code == 206 and "Range" in headers:
+            sz = state["received"]
+            exp_sz += sz
+            plog(f"[*][ Resuming download of {fout} at {sz} b ]")
+            f = open(fout + DOWNLOAD_PART_SUFFIX, "r+b")
+            f.truncate(sz)
+            f.seek(sz)
+            md5 = file_md5(fout + DOWNLOAD_PART_SUFFIX, sz)  # the received part
+        elif (
+            state
+            and "segments" in state
+            and state["etag"] == etag
+            and state["size"] == exp_sz
+        ):
+            plog(f"[*][ Resuming segmented download of {fout} ]")
+            use_ranges = True
+        else:
+            if state:
+                plog(f"[*][ {fout} changed on the server, restarting download ]")
+            state = None
+            if fout and segmented and download_ranges(r.headers, exp_sz):
+                use_ranges = True
+            elif fout and download_to_disk(r.headers, exp_sz):
+                plog(f"[*][ Streaming download to {fout} ]")
+                if exp_sz:
+                    check_disk_free(fout, exp_sz)
+                f = open(fout + DOWNLOAD_PART_SUFFIX, "wb")
+        if f is not None and state is None:
+            state = {"url": url, "etag": etag, "size": exp_sz, "received": sz}
+        chunks = r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        if use_ranges:  # the segments fetch the body
+            chunks = ()
+        sz0 = sz
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                md5.update(chunk)
+                if f is None:
+                    resp += chunk
+                    if fout and len(resp) > STREAM_MEM_MAX:
+                        plog(f"[*][ Response over {STREAM_MEM_MAX} b, spill to {fout} ]")
+                        f = open(fout + DOWNLOAD_PART_SUFFIX, "wb")
+                        f.write(resp)
+                        resp = bytearray()
+                        state = {"url": url, "etag": etag, "size": exp_sz, "received": 0}
+                else:
+                    f.write(chunk)
+                if (sz + len(chunk)) // DOWNLOAD_PROGRESS_STEP != sz // DOWNLOAD_PROGRESS_STEP:
+                    get_download_size(sz + len(chunk), exp_sz)
+                    if f is not None:
+                        f.flush()
+                        state["received"] = sz + len(chunk)
+                        part_state_write(fout, state)
+                sz += len(chunk)
+        finally:
+            if f is not None:
+                f.close()
+                state["received"] = sz
+                part_state_write(fout, state)
+            metric_inc("download_bytes_total", sz - sz0, host=urlsplit(url).hostname)
+    if use_ranges:
+        if state is None:
+            check_disk_free(fout, exp_sz)
+        try:
+            res = download_file_segmented(
+                session, url, params, basicauth, fout, exp_sz, etag, state
+            )
+            # the ranges arrive out of order, no md5 while streaming: the entry
+            # is stored without one, checksum_ok reads the file once when DHuS
+            # publishes an md5 to check it against, else it is never read
+            http_cache_drop(fout)  # not the digest of a former download
+            http_cache_put(url, fout, r.headers, exp_sz)
+            http_cache_stat(url, fout)
+            return res
+        except RangeNotHonoured as e:
+            exc_handl(e, "[!][ Segmented download failed, one stream fallback ]")
+            part_state_clear(fout)
+            return download_file(url, params, basicauth, fout, segmented=False)
+    get_download_size(sz, exp_sz)
+    if fout:  # the caller writes an in memory response to fout
+        http_cache_put(url, fout, r.headers, sz, md5.hexdigest())
+    if f is not None:
+        if exp_sz and sz != exp_sz:
+            raise requests.ConnectionError(f"{fout} short read {sz} b of {exp_sz} b")
+        part_done(fout)
+        http_cache_stat(url, fout)
+        return Path(fout)
+    return bytes(resp)  # .decode("utf-8","replace")
 
 
 # def get_api_head(url):
@@ -490,7 +1433,7 @@ def download_file(url, params, basicauth):
 
 
 #
-# def 20231005 revert from rtc try to download data
+# 20261018 bounded per host by net_call
 def get_api(
     hostname,
     sub_url,
@@ -499,9 +1442,36 @@ def get_api(
     params=dict(),
     post=False,
     is_stream=False,
+    fout=None,
+):
+    return net_call(
+        hostname,
+        get_api_sync,
+        hostname,
+        sub_url,
+        user,
+        password,
+        params,
+        post,
+        is_stream,
+        fout,
+    )
+
+
+#
+# def 20231005 revert from rtc try to download data
+def get_api_sync(
+    hostname,
+    sub_url,
+    user=None,
+    password=None,
+    params=dict(),
+    post=False,
+    is_stream=False,
+    fout=None,
 ):
     # VARIABLES
-    url = "https://" + hostname + sub_url
+    url = http_base(hostname) + sub_url  # 20261018
     data = None
     resp = None
 
@@ -526,19 +1496,22 @@ def get_api(
         # rhead = get_url_head(url,auth=basicauth,params=params,timeout=DOWNLOAD_TIMEOUT)
         # resp = resp.text
         # if not resp:
-        resp = download_file(url, params, basicauth)
+        resp = download_file(url, params, basicauth, fout)
     except Exception as e:
         # ADV DEBUG: plog(resp)
         exc_handl(e, "[!] Cannot download the result page")
     # if resp:
     #  #plog("[O][ RESP[:80]: "+resp[:80])
     #  #plog("[O][ resp len: "+str(len(resp)))
+    if isinstance(resp, Path):  # 20261018 streamed to disk, nothing to parse
+        plog(f"[D] sucess at: {url} stored: {str(resp)}")
+        return resp
     # PARSE THE JSON
     try:
         # if resp and len(resp.text) < MAX_JSON_PARSE*1024:
         data = resp
         if resp:
-            if len(resp) < MAX_JSON_PARSE * 1024:
+            if len(resp) < MAX_JSON_PARSE * 1024 * 1024 and fout is None:
                 # resp=resp.decode("utf-8")
                 # data = resp.json() # Check the JSON Response Content documentation below
                 # plog(f"[D] str(type(resp)): {str(type(resp))}")
@@ -614,49 +1587,6 @@ def get_source_metadata(config, P_ID):
 # get_source_metadata(config,P_ID)
 
 
-#
-# REQ 20230801002 Obtains metadata for the given product from DHuS storage | 004
-# GET SOURCE DHR PRODUCTS
-#
-# TITLE='xmlstarlet sel -d -T -t -v "//_:entry/_:title" node.xml'
-# PREFIX='xmlstarlet sel -d -T -t -v "//_:entry/_:id" node.xml'
-#
-def update_source_metadata_nodexml(fname, TITLE):
-    xml = fread(fname)
-    plog(f"[*][ str(xml) update nodexml: {str(xml)[:500]}")
-    # plog(xml)
-    src_xml = bs.BeautifulSoup(xml, features="xml")
-    titles = []
-    ids = []
-    # for val in src_xml.find_all('entry')[:3]: # LIMITED
-    id = ""
-    for val in src_xml.find_all("entry"):  # LIMITED
-        title = str(val.find("title").get_text())
-        titles.append(title)
-        plog(title)
-        id = str(val.find("id").get_text())
-        ids.append(id)
-        plog(id)
-        break
-    if len(titles) > 0:
-        plog("TITLE: " + titles[0])
-    # if id:
-    #  PREFIX=id
-    # ID=titles[0]
-    # PLATFORM=ID[0:2]
-    # plog("PLATFORM: "+PLATFORM)
-    # plog("PREFIX: "+PREFIX)
-    # PRODUCTURL="/".join(id.split("/")[:-1])
-    # plog("PRODUCTURL: "+PRODUCTURL)
-    # plog("Platform from title:"
-    return titles
-
-
-# update node.xml TEST
-# CID,PLATFORM,titles=update_source_metadata_nodexml("node.xml")
-# plog("CID: "+CID + " PLATFORM: " + PLATFORM)
-
-
 def platform2fname_manifest(P_ID, TITLE, PLATFORM):
     # ADD 20231101
     FNAME_MANIFEST = "manifest.safe"
@@ -744,7 +1674,9 @@ def platform2manifest_url(P_ID, TITLE, PLATFORM, SUFFIX):
 # /MTD_MSIL2A.xml|MTD_MSIL1C.xml|/MTD_TL.xml|annotation/s1a.*xml"
 # sed 's/.*href="//' | sed 's/".*//' |
 #
-def get_source_metadata_manifest_safe(config, P_ID, TITLE, PLATFORM, SUFFIX="SAFE"):
+# 20261018 md5: the product Checksum DHuS publishes, checked for the S5P
+# $value download, a mismatch removes the file and fails the product
+def get_source_metadata_manifest_safe(config, P_ID, TITLE, PLATFORM, SUFFIX="SAFE", md5=None):
     FNAME_MANIFEST = platform2fname_manifest(P_ID, TITLE, PLATFORM)
     plog(f"FNAME_MANIFEST {FNAME_MANIFEST}")
     sub_url = platform2manifest_url(P_ID, TITLE, PLATFORM, SUFFIX)
@@ -758,9 +1690,12 @@ def get_source_metadata_manifest_safe(config, P_ID, TITLE, PLATFORM, SUFFIX="SAF
         sub_url,
         user=config["source"]["username"],
         password=config["source"]["password"],
+        fout=fpath_out(FNAME_MANIFEST, TITLE),  # 20261018 S5P product streamed
     )  # CONF
     # ADV DEBUG plog(res.split('\n')[:10])
-    if res:
+    if isinstance(res, Path):
+        plog(f"[o] PLATFORM: {PLATFORM}, FNAME: {FNAME_MANIFEST} file streamed.")
+    elif res:
         # CREATE DIR IF IT DOES NOT EXISTS
         # try:
         #    os.mkdir(FDIR_OUT + TITLE)
@@ -789,6 +1724,15 @@ def get_source_metadata_manifest_safe(config, P_ID, TITLE, PLATFORM, SUFFIX="SAF
     else:
         msg = f"[*] CANNOT SAVE MANIFEST FILE {FNAME_MANIFEST}"
         osexit(P_EXIT_FAILURE)
+    fout = fpath_out(FNAME_MANIFEST, TITLE)
+    if not checksum_ok(http_base(server) + sub_url, fout, md5):
+        plog(f"[!][ {FNAME_MANIFEST} checksum failed, product not registered ]")
+        try:
+            os.remove(fout)  # not left for stactools or a cached run
+        except OSError:
+            pass
+        http_cache_drop(fout)
+        osexit(P_EXIT_FAILURE)
     # return TITLE + os.sep + FNAME_MANIFEST
     return FNAME_MANIFEST
 
@@ -841,29 +1785,37 @@ def get_source_metadata_all(ID, TITLE, PLATFORM):
     # os.makedirs(FDIR_OUT + TITLE, exist_ok=True)
     # fname_manifest=FNAME_MANIFEST
     plog("[*] MANIFEST READ: " + TITLE + os.sep + FNAME_MANIFEST)
+    # fwrite(ID+os.sep+FNAME_MANIFEST,mnfst)
+    file_locs = []
+    md5s = []  # 20261018 MD5 checksum of the byteStream, None when missing
+    HREF = None
     try:
-        mnfst = fread(FNAME_MANIFEST, FDIR=TITLE)
-    except Exception as e:
+        # 20261018 streamed from the file, only fileLocation/@href is read
+        # and the checksum following it in the same byteStream
+        for val in xml_iter(
+            patch_fdir(TITLE) + FNAME_MANIFEST, ("fileLocation", "checksum")
+        ):
+            if val.tag.rsplit("}", 1)[-1] == "checksum":
+                if HREF is not None and val.get("checksumName", "").upper() == "MD5":
+                    if file_locs and md5s[-1] is None and file_locs[-1] == HREF:
+                        md5s[-1] = (val.text or "").strip() or None
+                HREF = None
+                continue
+            HREF = None
+            # 20231004 MP added tiff filter
+            # GET ONLY METADATA NODES NAMES
+            if ".tiff" not in val.get("href"):
+                if ".jp2" not in val.get("href"):
+                    if ".gml" not in val.get("href"):
+                        HREF = val.get("href")
+                        file_locs.append(HREF)
+                        md5s.append(None)
+            # FNAME=FDIR_OUT+TITLE+os.sep+(os.sep.join(tmp_href.split(os.sep)))
+            plog("href: " + str(HREF), MTRACE)
+            # plog("fname: "+str(FNAME))
+    except (OSError, ET.ParseError) as e:
         plog(f"[!][ RS ERR ][ MANIFEST SAFE NOT READY {str(e)}]")
         osexit(P_EXIT_FAILURE)
-    # fwrite(ID+os.sep+FNAME_MANIFEST,mnfst)
-    src_mnfst = bs.BeautifulSoup(mnfst, features="xml")
-    for val in src_mnfst.find_all("entry")[:3]:  # LIMITED
-        plog(str(val))
-    file_locs = []
-    for val in src_mnfst.find_all("fileLocation"):  # NOT LIMITED
-        # 20231004 MP added tiff filter
-        # GET ONLY METADATA NODES NAMES
-        if ".tiff" not in val.get("href"):
-            if ".jp2" not in val.get("href"):
-                if ".gml" not in val.get("href"):
-                    HREF = val.get("href")
-                    file_locs.append(HREF)
-                    if HREF[:2] == "./":
-                        HREF = HREF[2:]  # 20231109
-        # FNAME=FDIR_OUT+TITLE+os.sep+(os.sep.join(tmp_href.split(os.sep)))
-        plog("href: " + str(HREF))
-        # plog("fname: "+str(FNAME))
     # for idx, loc in enumerate(file_locs):
     #  plog("[ "+str(idx)+" ][ "+loc+" ]")
     src_fnames = []
@@ -877,70 +1829,102 @@ def get_source_metadata_all(ID, TITLE, PLATFORM):
     # ADV DEBUG plog(src_paths)
     # for idx, loc in enumerate(src_fnames):
     #  plog("[ "+str(idx)+" ][ "+loc+" ] [ "+src_fpaths[idx]+" ]")
-    return (src_fnames, src_fpaths)
+    return (src_fnames, src_fpaths, md5s)
 
 
 # TEST
 # get_source_metadata_all(ID)
 
 
-def get_metadata_file(TITLE, config, urls, src_fpaths, src_fnames):
+# 20261018 one metadata file, returns False when the download failed
+# md5 of the manifest: a cached file with another md5 is downloaded again,
+# a download with another md5 is retried once, then it failed
+def get_metadata_file_one(TITLE, config, url, src_fpath, src_fname, md5=None):
     src_server = config["source"]["url"]
-    for x in range(len(urls)):
-        tfname = TITLE + os.sep + src_fpaths[x] + os.sep + src_fnames[x]
-        tdir = FDIR_OUT + os.sep + TITLE + os.sep + src_fpaths[x]
-        tdirx = TITLE + os.sep + src_fpaths[x]
-        # newdir = Path(tdir)
-        # newdir.mkdir(parents=True, exist_ok=True)  # 20231019
-        # print("[+] mkdir: " + tdir + " ... [ O.K. ]")
-        plog("urls [" + str(x) + "]: " + urls[x] + " -> " + tdir)
-        # 20231020
-        # fverify(tfname, res, tdirx)  # 20231114
-        # try to get dest size
-        exp_sz = 0
-        fdown_sz = 0
-        if USE_CACHE is True:
-          try:
-              tmp_basicauth = None
-              user = config["source"]["username"]
-              password = config["source"]["password"]
-              if user and password:
-                  tmp_basicauth = HTTPBasicAuth(user, password)
-              tmp_url = "https://" + src_server + urls[x]
-              tmp_params = dict()
-              with requests.get(
-                  tmp_url, params=tmp_params, auth=tmp_basicauth, stream=True
-              ) as r:
-                  if "Content-Length" in r.headers:
-                      exp_sz = int(r.headers["Content-Length"])
-                      # plog()
-              fdown_sz = len(fread(tfname, FDIR="./"))
-          except Exception as e:
-              exc_handl(
-                  e, f"[*] Expected download size: {str(exp_sz)} b Error: {str(e)} ]"
-              )
-          plog(f"[I] re-download decision exp_sz: {exp_sz} fdown_sz: {fdown_sz} ")
-        # IF NO CACHE IT USES exp_sz AND fdown_sz default to 0
-        if exp_sz != fdown_sz:
-            # GET THE FILE
-            res = get_api(
-                src_server,
-                urls[x],
-                user=config["source"]["username"],
-                password=config["source"]["password"],
-                is_stream=False,
-            )
-            if res:
-                if isinstance(res, bytes):
-                    fwrite(tfname, res, tdirx)  # 20231108 # handle binary files
-                    # fwrite(tfname, res, bin=True)  # 20231108 # handle binary files
-                else:
-                    fwrite(tfname, res, tdirx)  # 20231114
-                print("[v] Download: " + urls[x] + " ... [ O.K. ]")
+    tfname = TITLE + os.sep + src_fpath + os.sep + src_fname
+    tdir = FDIR_OUT + os.sep + TITLE + os.sep + src_fpath
+    tdirx = TITLE + os.sep + src_fpath
+    plog("url: " + url + " -> " + tdir)
+    fout = fpath_out(tfname, tdirx)
+    furl = http_base(src_server) + url  # the http cache key
+    # 20261018 cache: HEAD for files without validators, the conditional GET
+    # of get_api answers 304 for unchanged files with validators
+    if USE_CACHE is True:
+        try:
+            tmp_basicauth = None
+            user = config["source"]["username"]
+            password = config["source"]["password"]
+            if user and password:
+                tmp_basicauth = HTTPBasicAuth(user, password)
+            if http_cache_head(furl, fout, tmp_basicauth):
+                if checksum_ok(furl, fout, md5):
+                    plog(f"[C] File Download skip (cached) File: {tfname}")
+                    metric_inc("cache_requests_total", result="hit")
+                    return True
+                http_cache_drop(fout)
+        except Exception as e:
+            exc_handl(e, f"[*] Cache check of {tfname} Error: {str(e)} ]")
+    for attempt in range(2):
+        # GET THE FILE
+        res = get_api(
+            src_server,
+            url,
+            user=config["source"]["username"],
+            password=config["source"]["password"],
+            is_stream=False,
+            fout=fout,  # 20261018
+        )
+        if isinstance(res, Path):
+            plog("[v] Download: " + url + " ... [ O.K. ] on disk")
+        elif res:
+            if isinstance(res, bytes):
+                fwrite(tfname, res, tdirx)  # 20231108 # handle binary files
+                # fwrite(tfname, res, bin=True)  # 20231108 # handle binary files
             else:
-                print("[!] failed to download: " + urls[x] + " ... [ X ]")
+                fwrite(tfname, res, tdirx)  # 20231114
+            http_cache_stat(furl, fout)
+            plog("[v] Download: " + url + " ... [ O.K. ]")
         else:
-            print(f"[C] File Download skip (cached) File: {tfname} Size: {fdown_sz}")
+            plog("[!] failed to download: " + url + " ... [ X ]", MWARNING)
+            return False
+        if checksum_ok(furl, fout, md5):
+            return True
+        http_cache_drop(fout)  # no validators, the next get is a full download
+    plog("[!] checksum failed: " + url + " ... [ X ]", MWARNING)
+    try:
+        os.remove(fout)  # not left for stactools or a cached run
+    except OSError:
+        pass
+    http_cache_drop(fout)
+    return False
+
+
+# 20261018 metadata files fetched on the network pool, METADATA_WORKERS at once
+# over the pooled http client, returns the list of urls which failed
+def get_metadata_file(TITLE, config, urls, src_fpaths, src_fnames, md5s=None):
+    failed = []
+    md5s = md5s or [None] * len(urls)
+    workers = max(1, min(METADATA_WORKERS, len(urls)))
+    plog(f"[*][ Metadata files: {len(urls)} workers: {workers} ]")
+    results = net_map(
+        get_metadata_file_one,
+        [
+            (TITLE, config, urls[x], src_fpaths[x], src_fnames[x], md5s[x])
+            for x in range(len(urls))
+        ],
+        workers,
+    )
+    for x, res in enumerate(results):
+        if isinstance(res, Exception):
+            exc_handl(res, f"[!] failed to download: {urls[x]}")
+            failed.append(urls[x])
+        elif not res:
+            failed.append(urls[x])
+    if failed:
+        plog(f"[!][ {len(failed)} of {len(urls)} metadata files failed ]")
+        for url in failed:
+            plog(f"[!][ failed: {url} ]")
+    return failed
 
 
 # PATIENCE (takes cca 10 secs., opt. candidate)
@@ -957,7 +1941,7 @@ def metadata_json_patch(config, server, src_fnames, src_paths, PROD_ID, NODE_NAM
         # subprod+="/Nodes('"+elem+"')"
         subprod = "/Nodes('" + elem.replace("/", "')/Nodes('") + "')"
 
-        plog("MJPE: " + elem)
+        plog("MJPE: " + elem, MTRACE)
         # url = "/odata/v1/Products('"+PROD_ID+"')/Nodes('"+NODE_NAME+"')"+subprod+"" # 20231020
         url = (
             "/odata/v1/Products('"
@@ -986,44 +1970,236 @@ def metadata_json_patch(config, server, src_fnames, src_paths, PROD_ID, NODE_NAM
 # MAPS SOURCE PRODUCT NAMES TO TARGET NAMES COLLECTIONS
 
 
+# 20261018 rules from the optional [collections] section, one per line:
+# <collection> = <pattern> [ more patterns on the continuation lines ]
+# prefix = <test prefix> replaces DST_COL_TEST_PREFIX [ empty for none ]
+def col_router_setup(config):
+    global COL_RULES, COL_ROUTER, DST_COL_TEST_PREFIX
+    if "collections" not in config:
+        return
+    rules = []
+    for col, patterns in config["collections"].items():
+        if col == "prefix":
+            DST_COL_TEST_PREFIX = patterns.strip()
+            continue
+        for pattern in patterns.split():
+            rules.append([pattern.lstrip("^"), col])
+    if rules:
+        COL_RULES = rules
+        COL_ROUTER = None
+    plog(f"[*] CFG COLLECTIONS: {len(COL_RULES)} rules PREFIX: {DST_COL_TEST_PREFIX}")
+
+
+# 20261018 all the rules in one alternation, a named group per rule, the
+# group of a match [ lastgroup ] is its rule, one match call per title
+def col_router():
+    global COL_ROUTER
+    if COL_ROUTER is None:
+        alt = "|".join(f"(?P<r{i}>{rule[0]})" for i, rule in enumerate(COL_RULES))
+        COL_ROUTER = (re.compile(alt), {f"r{i}": rule[1] for i, rule in enumerate(COL_RULES)})
+    return COL_ROUTER
+
+
+# 20261018 bulk api: yields the target collection for each title, a title
+# no rule matches is passed as it is [ as translate_prod2col always did ]
+def route_collections(titles, test_col_prefix=None):
+    if test_col_prefix is None:
+        test_col_prefix = DST_COL_TEST_PREFIX
+    router, cols = col_router()
+    for x in titles:
+        m = router.match(x)
+        yield test_col_prefix + (cols[m.lastgroup] if m else x)
+
+
 def translate_prod2col(titles, PLATFORM, test_col_prefix=DST_COL_TEST_PREFIX):
     # TEST ONLY
     # test_col_prefix="mp-"
+    # 20261018 compiled router, the result is the collection of the last title
+    res_title = None
+    for x, res_title in zip(titles, route_collections(titles, test_col_prefix)):
+        plog(str(x) + " -> " + res_title)
+    return res_title
+    # s/^S2[A-DP]_MSIL2A_.*/sentinel-2-l2a/
 
-    rearr = [
-        ["^S1[A-DP]_.._GRD[HM]_.*", "sentinel-1-grd"],
-        ["^S1[A-DP]_.._SLC__.*", "sentinel-1-slc"],
-        ["^S1[A-DP]_.._RAW__.*", "sentinel-1-raw"],
-        ["^S1[A-DP]_.._OCN__.*", "sentinel-1-ocn"],
-        ["^S2[A-DP]_MSIL1B_.*", "sentinel-2-l1b"],
-        ["^S2[A-DP]_MSIL1C_.*", "sentinel-2-l1c"],
-        ["^S2[A-DP]_MSIL2A_.*", "sentinel-2-l2a"],
-        ["^S3[A-DP]_OL_1_.*", "sentinel-3-olci-l1b"],
-        ["^S3[A-DP]_OL_2_.*", "sentinel-3-olci-l2"],
-        ["^S3[A-DP]_SL_1_.*", "sentinel-3-slstr-l1b"],
-        ["^S3[A-DP]_SL_2_.*", "sentinel-3-slstr-l2"],
-        ["^S3[A-DP]_SR_1_.*", "sentinel-3-stm-l1"],
-        ["^S3[A-DP]_SR_2_.*", "sentinel-3-stm-l2"],
-        ["^S3[A-DP]_SY_1_.*", "sentinel-3-syn-l1"],
-        ["^S3[A-DP]_SY_2_.*", "sentinel-3-syn-l2"],
-        ["^S5[A-DP]_OFFL_L1_.*", "sentinel-5p-l1"],
-        ["^S5[A-DP]_NRTI_L1_.*", "sentinel-5p-l1"],
-        ["^S5[A-DP]_OFFL_L2_.*", "sentinel-5p-l2"],
-        ["^S5[A-DP]_NRTI_L2_.*", "sentinel-5p-l2"],
-    ]
 
-    res_title = None
+# 20261018 stac backend from the optional [stac] section
+def stac_setup(config):
+    global STAC_BACKEND, STAC_BIN, STAC_WORKERS
+    if "stac" not in config:
+        return
+    STAC_BACKEND = config["stac"].get("backend", STAC_BACKEND)
+    STAC_BIN = config["stac"].get("bin", STAC_BIN)
+    STAC_WORKERS = config["stac"].getint("workers", STAC_WORKERS)
+    for platform in STAC_CREATE_ITEM:  # 20261018 s1 = module with create_item
+        STAC_CREATE_ITEM[platform] = config["stac"].get(
+            platform.lower(), STAC_CREATE_ITEM[platform]
+        )
+    plog(f"[*] CFG STAC BACKEND: {STAC_BACKEND} BIN: {STAC_BIN} WORKERS: {STAC_WORKERS}")
+
+
+# 20261018 stactools in-process [ no interpreter start, no re-import of
+# stactools, shapely, pystac and rasterio per product ]
+# same output as the cli: SRC_DIR/<item id>.json, returns the pystac Item
+def run_stac_tools_inproc(platform, title, SRC_DIR="./"):
+    create_item = importlib.import_module(STAC_CREATE_ITEM[platform]).create_item
+    item = create_item(title)
+    item.set_self_href(os.path.join(SRC_DIR, f"{item.id}.json"))
+    item.make_asset_hrefs_relative()
+    item.save_object()
+    plog(f"[*][ STAC item {item.id} created in-process ]")
+    return item
+
+
+# 20261018 PROFILING
+def prof_setup(profile, trace_malloc):
+    global PROFILE, TRACE_MALLOC
+    PROFILE = profile
+    TRACE_MALLOC = trace_malloc
+    if TRACE_MALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def prof_fname(name, stage, ext):
+    fdir = patch_fdir(PROFILE_DIR)
+    Path(fdir).mkdir(parents=True, exist_ok=True)
+    return f"{fdir}{os.path.basename(str(name))}_{stage}.{ext}"
+
+
+# fn(*args) under cProfile and / or tracemalloc, named name_stage
+# cProfile sees the calling thread only [ the requests on the network
+# pool show as the future waits ], the tracemalloc peak is of the process
+def prof_call(name, stage, fn, *args):
+    if not PROFILE and not TRACE_MALLOC:
+        return fn(*args)
+    prof = None
+    if TRACE_MALLOC:
+        tracemalloc.reset_peak()
+    if PROFILE:
+        prof = cProfile.Profile()
+        prof.enable()
+    try:
+        return fn(*args)
+    finally:
+        if prof is not None:
+            prof.disable()
+            prof.dump_stats(prof_fname(name, stage, "pstats"))
+        if TRACE_MALLOC:
+            cur, peak = tracemalloc.get_traced_memory()
+            tracemalloc.take_snapshot().dump(prof_fname(name, stage, "tracemalloc"))
+            plog(f"[P][ {name} {stage} peak {peak / 2**20:.1f} MB now {cur / 2**20:.1f} MB ]")
+
+
+# 20261018 stac item process pool
+# the item generation is cpu bound [ geometry, xml ], one process per core,
+# the workers import stactools once at start and stay warm for the batch
+# forkserver: the parent already runs the network threads, no fork of them
+def stac_worker_init(backend, stac_bin, log_opts, prof_opts, create_item):
+    global STAC_BACKEND, STAC_BIN
+    log_setup(log_opts)
+    prof_setup(*prof_opts)
+    STAC_CREATE_ITEM.update(create_item)
+    STAC_BACKEND = backend
+    STAC_BIN = stac_bin
+    # 20261018 the parent stops the pool, a ctrl-c or a systemd stop of the
+    # process group must not kill the items in flight
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if STAC_BACKEND != "inproc":
+        return
+    for module in STAC_CREATE_ITEM.values():
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            plog(f"[!][ stac worker {os.getpid()} cannot preload {module} {str(e)} ]")
 
-    for x in titles:
-        # print(re.sub('^S2[A-DP]_MSIL2A_.*','sentinel-2-l2a',x))
-        for rule in rearr:
-            res_title = re.sub(rule[0], rule[1], x)
-            if res_title:
-                if x != res_title:
-                    plog(str(x) + " -> " + test_col_prefix + res_title)
-                    break
-    return test_col_prefix + res_title
-    # s/^S2[A-DP]_MSIL2A_.*/sentinel-2-l2a/
+
+def stac_pool():
+    global STAC_POOL
+    if STAC_POOL is None and STAC_WORKERS > 0:
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn"
+        )
+        STAC_POOL = ProcessPoolExecutor(
+            max_workers=STAC_WORKERS,
+            mp_context=ctx,
+            initializer=stac_worker_init,
+            initargs=(
+                STAC_BACKEND,
+                STAC_BIN,
+                dict(LOG_OPTS, queue=False),
+                (PROFILE, TRACE_MALLOC),
+                STAC_CREATE_ITEM,
+            ),
+        )
+        plog(f"[*][ STAC POOL {STAC_WORKERS} workers ]")
+    return STAC_POOL
+
+
+def stac_pool_shutdown():
+    global STAC_POOL
+    if STAC_POOL is not None:
+        STAC_POOL.shutdown(wait=True, cancel_futures=True)
+        STAC_POOL = None
+
+
+# 20261018 the item json the stac cli wrote [ it does not print the name ]:
+# the newest Feature in SRC_DIR written since the run started with assets
+# in the product directory, the workers running beside it write other ones
+def stac_cli_item(SRC_DIR, title, since_ns):
+    node = os.path.basename(title.rstrip(os.sep))
+    found = None
+    for entry in os.scandir(SRC_DIR):
+        if not entry.name.endswith(".json") or not entry.is_file():
+            continue
+        mtime = entry.stat().st_mtime_ns
+        if mtime < since_ns or (found and mtime < found[0]):
+            continue
+        try:
+            with open(entry.path, "r") as f:
+                doc = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(doc, dict) or doc.get("type") != "Feature":
+            continue
+        hrefs = [a.get("href") or "" for a in (doc.get("assets") or {}).values()]
+        if any(node in h and not h.startswith(("http:", "https:")) for h in hrefs):
+            found = (mtime, entry.path)
+    return found[1] if found else None
+
+
+# returns ( item json file or None when none was found, result code )
+# 20261018 and the seconds it took [ metrics of the parent process ]
+def stac_item_worker(platform, title, SRC_DIR):
+    started = time.monotonic()
+    since_ns = time.time_ns() - 10**9  # file system timestamp granularity
+    item, res = prof_call(
+        title, "run_stac_tools", run_stac_tools, STAC_BIN, platform, title, SRC_DIR
+    )
+    if res != 0:
+        return (None, res, time.monotonic() - started)
+    if hasattr(item, "get_self_href"):
+        return (item.get_self_href(), res, time.monotonic() - started)
+    return (stac_cli_item(SRC_DIR, title, since_ns), res, time.monotonic() - started)
+
+
+# the item of the staged product, a stage of its own for the profiles
+def stac_item_result(fut):
+    return fut.result()
+
+
+# submits the staged product, without a pool the item is made right away
+def stac_submit(product):
+    title = os.path.join(FDIR_OUT, product.node)
+    pool = stac_pool()
+    if pool is not None:
+        return pool.submit(stac_item_worker, product.platform, title, FDIR_OUT)
+    fut = Future()
+    try:
+        fut.set_result(stac_item_worker(product.platform, title, FDIR_OUT))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
 
 
 # REQ 20230801005 Runs stac-tools to generate a STAC Item description for the product | 001
@@ -1042,6 +2218,14 @@ def cmd_stac(params):
 def run_stac_tools(STAC_BIN, platform, title, SRC_DIR="./"):
     res=None
     plog("[I] TITLE TO RUN STAC TOOLS: " + str(title))
+    if STAC_BACKEND == "inproc" and platform in STAC_CREATE_ITEM:  # 20261018
+        try:
+            return (run_stac_tools_inproc(platform, title, SRC_DIR), 0)
+        except ImportError as e:
+            plog(f"[!][ stactools not importable, stac cli fallback {str(e)} ]")
+        except Exception as e:
+            exc_handl(e, "[!][ stactools create_item failed ]")
+            return (None, 100)
     # TBD: Explore windingw no fix
     params = []
     # 20230921
@@ -1204,7 +2388,19 @@ def update_json_hrefs(HOST, P_ID, fname, fname_out="resto-test_upload.json"):
 # --upload-file "new_${file}"
 
 
+# 20261018 bounded per host by net_call
 def upload_collection(config, fname_out, STAC_COL, PLATFORM):
+    return net_call(
+        config["target"]["url"],
+        upload_collection_sync,
+        config,
+        fname_out,
+        STAC_COL,
+        PLATFORM,
+    )
+
+
+def upload_collection_sync(config, fname_out, STAC_COL, PLATFORM):
     # basicauth=None
     resto_url = "resto-test.c-scale.zcu.cz"
     resto_url = config["target"]["url"]  # REVIEW TBD HERE
@@ -1223,8 +2419,8 @@ def upload_collection(config, fname_out, STAC_COL, PLATFORM):
     # open(path_file,'r').read()
     json_data = fread(fname_out)
     # files={'file': fobj})
-    resp = requests.post(
-        "https://" + resto_url + sub_url,
+    resp = http_client(resto_url).post(
+        http_base(resto_url) + sub_url,
         headers=headers,
         data=json_data,
         auth=basicauth,
@@ -1236,6 +2432,83 @@ def upload_collection(config, fname_out, STAC_COL, PLATFORM):
     return data
 
 
+# 20261018 BULK UPLOAD
+def upload_setup(config):
+    global UPLOAD_BATCH
+    UPLOAD_BATCH = config["target"].getint("upload_batch", UPLOAD_BATCH)
+    plog(f"[*] CFG UPLOAD BATCH: {UPLOAD_BATCH}")
+
+
+# the FeatureCollection body generated item by item, sent chunked
+def upload_body(features):
+    yield b'{"type": "FeatureCollection", "features": ['
+    for idx, feature in enumerate(features):
+        yield (b"," if idx else b"") + json.dumps(feature).encode("utf-8")
+    yield b"]}"
+
+
+# 20261018 bounded per host by net_call
+def upload_features(config, STAC_COL, features):
+    return net_call(
+        config["target"]["url"], upload_features_sync, config, STAC_COL, features
+    )
+
+
+# one POST of the items to /collections/STAC_COL/items, returns the resto
+# response as upload_collection does
+def upload_features_sync(config, STAC_COL, features):
+    resto_url = config["target"]["url"]
+    sub_url = "/collections/" + STAC_COL + "/" + "items"
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    ruser = config["target"]["username"].strip()
+    rpass = config["target"]["password"].strip()
+    basicauth = HTTPBasicAuth(ruser, rpass)
+    plog(f"{resto_url}{sub_url} [ {len(features)} items ]")
+    resp = http_client(resto_url).post(
+        http_base(resto_url) + sub_url,
+        headers=headers,
+        data=upload_body(features),
+        auth=basicauth,
+    )
+    return json.loads(resp.text)
+
+
+# splits a bulk response into one upload_collection like response per item,
+# the features come back with productIdentifier = the item id
+def upload_results(upload_res, features):
+    if "ErrorMessage" in upload_res:
+        return [upload_res] * len(features)
+    if "status" not in upload_res:  # 20261018 [ an error page ] not inserted
+        return [{"ErrorMessage": f"no upload status: {str(upload_res)[:200]}"}] * len(features)
+    by_id = {}
+    for feat in upload_res.get("features", []):
+        by_id[feat.get("productIdentifier")] = feat
+    results = []
+    for feature in features:
+        feat = by_id.get(feature["id"])
+        if feat is None:
+            errors = [
+                x for x in upload_res.get("errors", []) if feature["id"] in json.dumps(x)
+            ]
+            results.append(
+                {
+                    "ErrorMessage": f"item {feature['id']} not inserted",
+                    "errors": errors or upload_res.get("errors", []),
+                }
+            )
+            continue
+        results.append(
+            {
+                "status": "success",
+                "inserted": 1,
+                "inError": 0,
+                "features": [feat],
+                "errors": [],
+            }
+        )
+    return results
+
+
 # TBD: test reupload
 # upload_collection()
 
@@ -1245,10 +2518,14 @@ def upload_collection(config, fname_out, STAC_COL, PLATFORM):
 # --upload-file "new_${file}"
 
 
+# 20261018 bounded per host by net_call
 def test_resto_api(config):
+    return net_call(config["target"]["url"], test_resto_api_sync, config)
+
+
+def test_resto_api_sync(config):
     # basicauth=None
     data = None
-    server_protocol = "https://"
     # resto_url="resto-test.c-scale.zcu.cz"
     resto_url = config["target"]["url"]  # REVIEW TBD HERE
     sub_url = ""
@@ -1262,8 +2539,8 @@ def test_resto_api(config):
     # print(ruser+" "+rpass) # DEBUG
     basicauth = HTTPBasicAuth(ruser, rpass)
     plog(resto_url + sub_url)
-    resp = requests.get(
-        server_protocol + resto_url + sub_url, headers=headers, auth=basicauth
+    resp = http_client(resto_url).get(
+        http_base(resto_url) + sub_url, headers=headers, auth=basicauth
     )
     # print(resp.text) # DEBUG
     # noway
@@ -1278,6 +2555,47 @@ def test_resto_api(config):
     return data
 
 
+# 20261018 BATCHED VERIFICATION
+# the featureIds of an upload checked by the search ids filter, VERIFY_BATCH
+# per request instead of one item GET each, returns the featureIds found
+def verify_items_sync(config, STAC_COL, FEATURE_IDS):
+    resto_url = config["target"]["url"]
+    headers = {"Accept": "application/json"}
+    ruser = config["target"]["username"].strip()
+    rpass = config["target"]["password"].strip()
+    basicauth = HTTPBasicAuth(ruser, rpass)
+    found = set()
+    started = time.monotonic()
+    for idx in range(0, len(FEATURE_IDS), VERIFY_BATCH):
+        end = idx + VERIFY_BATCH
+        ids = FEATURE_IDS[idx:end]
+        resp = http_client(resto_url).get(
+            http_base(resto_url) + "/search",
+            params={"collections": STAC_COL, "ids": ",".join(ids), "limit": len(ids)},
+            headers=headers,
+            auth=basicauth,
+            timeout=DOWNLOAD_TIMEOUT,
+        )
+        resp.raise_for_status()
+        for feat in resp.json().get("features", []):
+            found.add(feat.get("id"))
+    metric_observe("verify_seconds", time.monotonic() - started, collection=STAC_COL)
+    plog(f"[V][ {STAC_COL}: {len(found)} of {len(FEATURE_IDS)} items found ]")
+    return found
+
+
+# runs on the network pool behind the uploads, returns the future
+def verify_submit(config, STAC_COL, FEATURE_IDS):
+    return net_pool().submit(
+        net_call,
+        config["target"]["url"],
+        verify_items_sync,
+        config,
+        STAC_COL,
+        FEATURE_IDS,
+    )
+
+
 # TEST URL ROUTINES
 
 
@@ -1301,50 +2619,264 @@ def test_target_url(config):
     return res
 
 
-#  GET PRODUCT NAME BY ID
-def get_product_name_by_id(pro_meta, HOST):
-    SID = None
+# 20261018 PRODUCT CACHE
+# product directories under FDIR_OUT are evicted least recently used first
+# when the budget is exceeded or when older than max_age, directories with
+# a pin of a running process are never evicted
+# 20261018 the pin is a shared flock held by the running product, the
+# eviction takes it exclusive for the rmtree, a dead process holds none
+def cache_setup(config):
+    global CACHE_BUDGET, CACHE_MAX_AGE, CACHE_PURGE_VERIFIED
+    if "cache" not in config:
+        return
+    cache = config["cache"]
+    CACHE_BUDGET = cache.getint("budget_mb", CACHE_BUDGET // 1024 // 1024) * 1024 * 1024
+    CACHE_MAX_AGE = cache.getint("max_age_days", CACHE_MAX_AGE // 86400) * 86400
+    CACHE_PURGE_VERIFIED = cache.getboolean("purge_verified", CACHE_PURGE_VERIFIED)
+    plog(f"[*] CFG CACHE BUDGET: {CACHE_BUDGET} b MAX AGE: {CACHE_MAX_AGE} s")
+
+
+def cache_pin(TITLE):
+    if TITLE in CACHE_PINNED:
+        return
+    fdir = patch_fdir(TITLE)
+    while True:
+        Path(fdir).mkdir(parents=True, exist_ok=True)
+        f = open(fdir + CACHE_PIN_FNAME, "a")
+        fcntl.flock(f, fcntl.LOCK_SH)  # waits for an eviction in progress
+        if os.path.exists(fdir + CACHE_PIN_FNAME):
+            break
+        f.close()  # evicted meanwhile, pin the new directory
+    CACHE_PINNED[TITLE] = f
+    os.utime(fdir)  # last use for the lru order
+
+
+def cache_unpin(TITLE):
+    f = CACHE_PINNED.pop(TITLE, None)
+    if f is not None:
+        try:
+            os.utime(patch_fdir(TITLE))  # the run wrote files, cache_dir_size
+        except OSError:
+            pass
+        f.close()
+
+
+def cache_unpin_all():
+    for TITLE in list(CACHE_PINNED):
+        cache_unpin(TITLE)
+
+
+# the exclusive pin lock of an unpinned directory, None when it is pinned
+def cache_pin_take(fdir):
+    f = open(os.path.join(fdir, CACHE_PIN_FNAME), "a")
     try:
-        pro_meta_arr = bs.BeautifulSoup(pro_meta, features="xml")
-        for val in pro_meta_arr.find_all("properties"):
-            for v in val.find_all("Name"):
-                plog("PROD NAME: " + v.get_text())
-                SID = v.get_text()
-        return SID
-    except Exception as e:
-        plog(e)
-        plog("[!] Cannot read product from " + HOST)
-        osexit(P_EXIT_FAILURE)
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
 
 
-def rmlock():
+def cache_du(fdir):
+    sz = 0
+    for entry in os.scandir(fdir):
+        if entry.is_dir(follow_symlinks=False):
+            sz += cache_du(entry.path)
+        else:
+            sz += entry.stat(follow_symlinks=False).st_size
+    return sz
+
+
+# 20261018 the size of a product directory from CACHE_SIZES while its
+# mtime is unchanged, the other directories are not walked again on each
+# eviction: files in subdirectories leave the mtime, cache_pin and
+# cache_unpin touch it, a product run of any instance is walked once after
+# it [ while pinned it is not evicted, its size may lag ]
+def cache_dir_size(fdir, mtime_ns):
+    known = CACHE_SIZES.get(fdir)
+    if known and known[0] == mtime_ns:
+        return known[1]
+    sz = cache_du(fdir)
+    CACHE_SIZES[fdir] = (mtime_ns, sz)
+    return sz
+
+
+def cache_evict():
+    if not CACHE_BUDGET and not CACHE_MAX_AGE:
+        return 0
+    now = datetime.datetime.now().timestamp()
+    products = []
+    seen = set()
+    for entry in os.scandir(patch_fdir(None)):
+        if entry.is_dir(follow_symlinks=False) and CACHE_PRODUCT_RE.match(entry.name):
+            st = entry.stat()
+            seen.add(entry.path)
+            products.append(
+                (st.st_mtime, entry.path, cache_dir_size(entry.path, st.st_mtime_ns))
+            )
+    for fdir in set(CACHE_SIZES) - seen:  # removed by another instance
+        CACHE_SIZES.pop(fdir, None)
+    products.sort()  # least recently used first
+    total = sum(sz for _, _, sz in products)
+    freed = 0
+    for mtime, fdir, sz in products:
+        over_budget = CACHE_BUDGET and total > CACHE_BUDGET
+        too_old = CACHE_MAX_AGE and now - mtime > CACHE_MAX_AGE
+        if not over_budget and not too_old:
+            continue
+        try:
+            pin = cache_pin_take(fdir)
+        except OSError:
+            continue
+        if pin is None:
+            continue
+        try:
+            shutil.rmtree(fdir)
+            CACHE_SIZES.pop(fdir, None)
+            total -= sz
+            freed += sz
+            plog(f"[*][ Cache evicted {fdir} {sz} b ]")
+        except OSError as e:
+            plog(f"[!][ Cache cannot evict {fdir} {str(e)} ]")
+        finally:
+            pin.close()
+    plog(f"[*][ Cache size {total} b budget {CACHE_BUDGET} b freed {freed} b ]")
+    return freed
+
+
+# 20261018 the product directory is not needed once the upload is verified
+def cache_release(TITLE):
+    cache_unpin(TITLE)
+    if CACHE_PURGE_VERIFIED:
+        try:
+            shutil.rmtree(patch_fdir(TITLE))
+            plog(f"[*][ Cache released {TITLE} ]")
+        except OSError as e:
+            plog(f"[!][ Cache cannot release {TITLE} {str(e)} ]")
+
+
+# 20261018 PRODUCT LOCKS
+# an exclusive flock of FDIR_OUT/.locks/<uuid>.lock for the product run,
+# False when another instance holds it, several instances share FDIR_OUT
+def product_lock(ID):
+    fdir = patch_fdir(LOCK_DIR)
+    Path(fdir).mkdir(parents=True, exist_ok=True)
+    f = open(fdir + re.sub(r"[^0-9A-Za-z._-]", "_", ID) + ".lock", "a")
     try:
-        dec_rm = fexists(FNAME_LOCK)  # TEST IF THE FILE EXISTS
-        if dec_rm: 
-          os.remove(FDIR_OUT +os.sep + FNAME_LOCK)
-    except Exception as e:
-        plog(f"[ ERR RS-0010 ][!][ CANNOT REMOVE THE LOCK FILE ERR: {str(e)}]")
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    f.truncate(0)
+    f.write(str(os.getpid()))  # for the operator only, the flock is the lock
+    f.flush()
+    PRODUCT_LOCKS[ID] = f
+    return True
+
+
+# the file stays, removing it would race with the next instance locking it
+def product_unlock(ID):
+    f = PRODUCT_LOCKS.pop(ID, None)
+    if f is not None:
+        f.close()
+
+
+def product_unlock_all():
+    for ID in list(PRODUCT_LOCKS):
+        product_unlock(ID)
+
+
+# 20261018 JOB STATE
+# one row per product in FDIR_OUT/register-stac.db [ WAL, the instances
+# sharing FDIR_OUT use the same store ], written by the main thread at each
+# completed stage, the verified products are read once into STATE_VERIFIED
+def state_setup(config):
+    global STATE_FNAME
+    if "state" in config:
+        STATE_FNAME = config["state"].get("file", STATE_FNAME)
+    plog(f"[*] CFG STATE: {STATE_FNAME or 'off'}")
+
+
+def state_open():
+    global STATE_DB
+    if STATE_DB is not None or not STATE_FNAME:
+        return STATE_DB
+    fname = os.path.join(patch_fdir(None), STATE_FNAME)
+    db = sqlite3.connect(fname, timeout=30, isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(STATE_SCHEMA)
+    STATE_VERIFIED.update(row[0] for row in db.execute("SELECT id FROM jobs WHERE verified = 1"))
+    STATE_DB = db
+    plog(f"[*][ State {fname}: {len(STATE_VERIFIED)} verified products ]")
+    return db
+
+
+def state_get(ID):
+    db = state_open()
+    if db is None:
+        return None
+    with STATE_LOCK:
+        row = db.execute("SELECT * FROM jobs WHERE id = ?", (ID,)).fetchone()
+    return dict(row) if row else None
+
+
+def state_save(ID, **cols):
+    db = state_open()
+    if db is None:
+        return
+    cols["updated"] = datetime.datetime.now().isoformat(timespec="seconds")
+    sets = ", ".join(f"{key} = excluded.{key}" for key in cols)
+    with STATE_LOCK:
+        db.execute(
+            f"INSERT INTO jobs (id, {', '.join(cols)}) VALUES (?{', ?' * len(cols)}) "
+            f"ON CONFLICT (id) DO UPDATE SET {sets}",
+            (ID, *cols.values()),
+        )
 
 
-# source info api print
-# res=test_target_url(config)
+# the outcome of the run, a skipped or a locked product keeps its row
+def state_done(result):
+    if result.get("resumed") == "verified" or result["code"] == P_EXIT_LOCKED:
+        return
+    cols = {
+        "code": result["code"],
+        "error": result.get("error"),
+        "seconds": result.get("seconds"),
+        "stages": json.dumps(result.get("stages", {})),
+    }
+    if result.get("verified"):
+        cols["feature_id"] = result["featureId"]
+        cols["stage"] = "verified"
+        cols["verified"] = 1
+        STATE_VERIFIED.add(result["id"])
+    state_save(result["id"], **cols)
+
+
+# the staged product and the stage to resume from, a stage whose files
+# are gone [ cache eviction, cleanup ] falls back to the one before it
+def state_resume(job):
+    if not job or not job.get("product") or job.get("stage") not in STATE_STAGES:
+        return None, None
+    product = Product.from_state(json.loads(job["product"]))
+    if not os.path.isdir(patch_fdir(product.node)):
+        return None, None
+    stage = job["stage"]
+    if stage == "uploaded" and not job.get("feature_id"):
+        stage = "published"
+    if stage == "published" and not os.path.isfile(
+        patch_fdir(None) + UPLOAD_FNAME.format(product.name)
+    ):
+        stage = "item"
+    if stage == "item" and not (
+        job.get("item") and os.path.isfile(patch_fdir(None) + job["item"])
+    ):
+        stage = "staged"
+    return product, stage
 
 
-def get_gsm(config, SRC_PROD_ID, TITLE):
-    fnodexml = "node.xml"
-    # download node.xml from source
-    gsm = get_source_metadata(config, SRC_PROD_ID)
-    # plog("GSM: "+gsm)
-    plog("[I] GSM DOWNLOADED")
-    if gsm:
-        # fnodexml=os.sep+TITLE+os.sep+"node.xml" # n1 bug at the stac runtime
-        fwrite(fnodexml, str(gsm), TITLE)  # HERE
-    else:
-        plog("Get Source Metadata Returns No Data.")
-    # plog(fnodexml)
-    plog("GSM DOWNLOADED :" + str(gsm))
-    plog("[*] GSM DOWNLOADED")
-    return fnodexml, gsm
+# source info api print
+# res=test_target_url(config)
 
 
 def get_suffix_from_titles(titles):
@@ -1359,15 +2891,948 @@ def get_suffix_from_titles(titles):
     return SUFFIX
 
 
-# 20231117 # get the product id soonest
-def get_src_prod_id_from_gsm(gsm):
-  src_xml = bs.BeautifulSoup(gsm, features="xml")
-  src_prod_id = ""
-  for val in src_xml.find_all("entry"):  # LIMITED
-      src_prod_id = str(val.find("Name").get_text())
-  #plog(f"src_prod_id: {src_prod_id}")
-  return(src_prod_id)
- 
+# 20261018 PRODUCT MODEL
+# one fetch and one parse of the product entry, the Nodes feed and the
+# manifest per product and run, the stages read from here
+class Product:
+    __slots__ = (
+        "id",  # input product id [ uuid ]
+        "name",  # entry Name
+        "title",  # entry title
+        "platform",  # S1 S2 S3 S5
+        "suffix",  # SAFE or the suffix of the title
+        "node",  # Nodes entry Name [ SRC_PROD_ID, product dir ]
+        "collection",  # target collection
+        "fnames",  # manifest metadata file names
+        "fpaths",  # and their paths in the product
+        "md5s",  # and their manifest MD5, None when not published
+        "checksum",  # entry Checksum of the product [ algorithm, value ]
+    )
+
+    def __init__(self, ID):
+        self.id = ID
+        self.name = None
+        self.title = None
+        self.platform = None
+        self.suffix = "SAFE"
+        self.node = None
+        self.collection = None
+        self.fnames = []
+        self.fpaths = []
+        self.md5s = []
+        self.checksum = None
+
+    # Products('ID')
+    def fetch_entry(self, config):
+        pro_meta = get_product_metadata(config, self.id)
+        try:
+            for val in xml_iter(pro_meta, ("entry",)):
+                self.title = xml_text(val, "title")
+                self.name = xml_text(val, "Name")
+                for ck in val.iter("{*}Checksum"):  # 20261018
+                    self.checksum = (xml_text(ck, "Algorithm"), xml_text(ck, "Value"))
+        except Exception as e:
+            exc_handl(e, "[!] Cannot read product from " + config["source"]["url"])
+            osexit(P_EXIT_FAILURE)
+        if not self.name:
+            plog("[!] Cannot read product from " + config["source"]["url"])
+            osexit(P_EXIT_FAILURE)
+        plog("PROD NAME: " + self.name)
+        self.title = self.title or self.name
+        self.platform = self.name[:2]
+        self.suffix = get_suffix_from_titles([self.title])
+
+    # Products('ID')/Nodes, the last entry Name is the product node
+    def fetch_nodes(self, config):
+        gsm = get_source_metadata(config, self.id)
+        plog("[*] GSM DOWNLOADED")
+        if not gsm:
+            plog("Get Source Metadata Returns No Data.")
+            osexit(P_EXIT_FAILURE)
+        for val in xml_iter(gsm, ("entry",)):  # LIMITED
+            self.node = str(xml_text(val, "Name"))
+        plog(f"src_prod_id: {self.node}")
+        if isinstance(gsm, (bytes, str)):
+            fwrite("node.xml", gsm, self.node)
+
+    # manifest of the product node [ S1 S2 S3 ], conditional get, one parse
+    def fetch_manifest(self, config):
+        get_source_metadata_manifest_safe(config, self.id, self.node, self.platform)
+        self.fnames, self.fpaths, self.md5s = get_source_metadata_all(
+            self.node, self.node, self.platform
+        )
+
+    # 20261018 the MD5 of the product $value, None for another algorithm
+    def md5(self):
+        if self.checksum and str(self.checksum[0]).upper() == "MD5":
+            return self.checksum[1]
+        return None
+
+    # 20261018 the staged product in the job state, for a resume
+    def to_state(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    @classmethod
+    def from_state(cls, state):
+        product = cls(state["id"])
+        for key in cls.__slots__:
+            if key in state:
+                setattr(product, key, state[key])
+        return product
+
+
+# 20261018 registers one product [ the former main body ]
+# osexit inside ends the product with ProductExit, see register_batch
+# 20261018 stage: source metadata and the product files in FDIR_OUT
+def stage_product(config, INP_PROD_ID):
+    #
+    # VARIABLES
+    #
+    SRC_PROD_ID = None
+
+    # FILE VARIABLES
+    check_source_id(INP_PROD_ID)
+    home_folder = os.getenv("HOME")
+    plog(f"[*][ RETRIEVED HOME FOLDER PATH {home_folder}]")
+
+    # STAC BINARY LOCATION [ STAC_BIN, dhus.ini [stac] ]
+    SRC_URL = config["source"]["url"]
+    DST_URL = config["target"]["url"]
+    SRC_PROD_NAME = None
+
+    # Retrieve product metadata from source [ 20261018 product model ]
+    product = Product(INP_PROD_ID)
+    product.fetch_entry(config)
+    # if PLATFORM!="S5":
+    #  fwrite(SRC_PROD_NAME, pro_meta)  # HERE
+    # SRC_PROD_NAME = SRC_PROD_NAME + ".SAFE"  # 20231116 thx zsustr
+    # 20231116 # get the product id soonest
+    product.fetch_nodes(config)
+    SRC_PROD_NAME = product.name
+    PLATFORM = product.platform
+    # 20231116
+    # fwrite(SRC_PROD_ID, pro_meta)  # HERE 20231116
+
+    DST_COLLECTION = None
+    SRC_PROD_ID = product.node
+    # 20261018 product cache: pin the product, make room for it
+    cache_pin(SRC_PROD_ID)
+    cache_evict()
+    # DEBUG RUNTIME CHECK
+    plog("[S] SOURCE PRODUCT ID   : " + SRC_PROD_ID)
+    plog("[S] SOURCE PRODUCT NAME : " + SRC_PROD_NAME)
+    plog("[S] SOURCE USER         : " + config["source"]["username"])
+    plog("[S] SOURCE HOST         : " + SRC_URL)
+    plog("[T] TARGET USER         : " + config["target"]["username"])
+    plog("[T] TARGET HOST         : " + DST_URL)
+    # plog("[I] TITLE               : " + TITLE) # 20231116
+    plog("[I] PLATFORM            : " + PLATFORM)
+    plog(f"[I] CHECKSUM            : {product.checksum}")  # 20261018
+    #
+    # TEST SOURCE AND TARGET AVAILABILITY [ TESTS ONLY? 20231030 ]
+    #
+    plog("[0] EVENT: getting source metadata manifest safe")
+    DST_COLLECTION = translate_prod2col([SRC_PROD_ID], PLATFORM, DST_COL_TEST_PREFIX)
+    #plog("DST_COLLECTION: " + DST_COLLECTION)        # 20231117
+    #DST_FILE=f"{FDIR_OUT}{os.sep}{SRC_PROD_ID}"
+    if PLATFORM == "S5":
+      #SRC_DIR=f"{SRC_PROD_ID}"
+      #TMP_DIR=f"{SRC_PROD_ID}_tmp{os.sep}"
+      #SRC_FILE=f"{TMP_DIR}{SRC_PROD_ID}"
+      #DST_FILE=f"{SRC_PROD_ID}{os.sep}{SRC_PROD_ID}"
+      #FILE_TEST=fexists(DST_FILE)
+      TRG_FNAME=f"{SRC_PROD_ID}"
+      #DST_FNAME=f"{SRC_PROD_ID}{os.sep}{SRC_PROD_ID}"
+      #FILE_TEST=fexists(DST_FNAME)
+      #TRG_TEST=fexists(TRG_FNAME)
+      #plog(f"[*] FILE_TEST {str(FILE_TEST)} {DST_FNAME}")
+      # 20231129
+      # TRY=1
+      # if TRG_TEST == 0:  # TEST IF THE FILE EXISTS
+      #   if TRY==1:
+      #     try:
+      #      shutil.move(FDIR_OUT+os.sep+SRC_DIR,FDIR_OUT+os.sep+TMP_DIR)
+      #      plog(f"[*] mv {SRC_DIR} {TMP_DIR}")
+      #    except Exception as e:
+      #      exc_handl(e, "[ ERR RS-1201 ][!][ FAILURE IN MAIN. ]")
+      #      plog(f"[ S5 ERROR ][ {str(e)} ]")
+      #      TRY=0
+      #  if TRY==1:
+      #    try:
+      #      shutil.move(FDIR_OUT+os.sep+SRC_FILE,FDIR_OUT+os.sep+TRG_FNAME)
+      #      plog(f"[*] mv {SRC_FILE} {DST_FNAME}")
+      #      TRY=0
+      #    except Exception as e:
+      #      exc_handl(e, "[ ERR RS-1202 ][!][ FAILURE IN MAIN. ]")
+      #      plog(f"[ S5 ERROR ][ {str(e)} ]")
+      #  if TRY==1:
+      #    try:
+      #      os.rmdir(FDIR_OUT+os.sep+TMP_DIR)
+      #      plog(f"[*] rmdir {TMP_DIR}")
+      #    except Exception as e:
+      #      exc_handl(e, "[ ERR RS-1203 ][!][ FAILURE IN MAIN. ]")
+      #      plog(f"[ S5 ERROR ][ {str(e)} ]")
+      #      TRY=0
+      #plog(f"[*] FILE_TEST {TRG_TEST} {fexists(TRG_FNAME)} {str(TRG_FNAME)}")
+      TRG_TEST=fexists(TRG_FNAME)
+      if TRG_TEST == 0:
+        fname_manifest = get_source_metadata_manifest_safe(
+          config, INP_PROD_ID, SRC_PROD_ID, PLATFORM, md5=product.md5()
+        )
+      plog(f"[0] EVENT: has source metadata manifest safe {fname_manifest}")
+      osexit(P_EXIT_SUCESS) # TMP 20231129
+    #plog(f"[0] EVENT: has source metadata manifest safe {fname_manifest}")
+    elif PLATFORM == "S1" or PLATFORM == "S2" or PLATFORM == "S3":
+
+      product.fetch_manifest(config)  # 20261018
+      titles = [product.title]
+      SUFFIX = product.suffix
+      plog(f"[*] titles: {str(titles)} SUFFIX: {SUFFIX}")
+      plog("[*] SRC_PROD_ID: " + SRC_PROD_ID)
+      # PLACEHOLDER FOR FIXED PROC_CMD_OPTS
+      # Get the manifest.safe
+      # GET ALL SOURCE METADATA - only for given sentinels
+      # if PLATFORM == "S1" or PLATFORM == "S2":
+      # Update node.xml source metadata
+
+      # ADV DEBUG
+      # plog("P_ID: " + SRC_PROD_ID)
+      # plog("titles: " + str(titles))
+      #
+      plog(
+          f"[*] titles {titles} PLATFORM {PLATFORM} COL_PREFIX {DST_COL_TEST_PREFIX}"
+      )
+
+      #
+      # GET DESTIONATION COLLECTION ID FROM PRODUCT ID
+      # 20231128
+      # DST_COLLECTION = translate_prod2col(titles, PLATFORM, DST_COL_TEST_PREFIX)
+      # plog("DST_COLLECTION: " + DST_COLLECTION)
+
+      src_fnames, src_paths = product.fnames, product.fpaths
+      # ADV DEBUG
+      # plog(f"src_fnames: {src_fnames[:3]}")
+      # plog(f"src_paths: {src_paths[:3]}")
+
+      #
+      # Patch the metadata
+      #
+      urls2, src_fpaths2, src_fnames2 = metadata_json_patch(
+          config, SRC_URL, src_fnames, src_paths, INP_PROD_ID, SRC_PROD_ID
+      )
+
+      plog("URLS2: " + str(urls2))
+      # These are the larger downloads
+      failed = get_metadata_file(
+          SRC_PROD_ID, config, urls2, src_fpaths2, src_fnames2, product.md5s
+      )
+      if failed:  # 20261018 no item from an incomplete product
+          plog(f"[!][ {len(failed)} metadata files failed, product not registered ]")
+          osexit(P_EXIT_FAILURE)
+
+      # ADV DEBUG
+      # plog("src_fnames[:3] " + str(src_fnames[:3]))
+      # plog("src_fpaths[:3] " + str(src_fpaths2[:3]))
+      # plog("urls2[:3] " + str(urls2[:3]))
+
+      # if titles:
+      #    if len(titles) > 0:
+      #        SRC_PROD_NAME = titles[0]
+      #    else:
+      #        SRC_PROD_NAME = titles
+      #plog(f"[*][ {SRC_PROD_NAME} ]")
+      #DST_COLLECTION = translate_prod2col(
+      #    [SRC_PROD_NAME], PLATFORM, DST_COL_TEST_PREFIX
+      #)  # 20231109
+
+      #
+      # DEBUG ID AND NAMES
+      #
+      plog("SOURCE PRODUCT ID: " + SRC_PROD_ID)
+      plog("PLATFORM: " + PLATFORM)
+      # Translate source product ID to target collection ID
+      # TBD REVIEW HERE CHECK IF COLLECTION EXISTS IN TARGET
+      # Run the stac tools [ TBD REVIEW TEST ONLY FOR S2A 20231018 ]
+      plog("[>] Run the stac tools [...]")
+      TITLE = titles[0]
+      # SRC_DIR="./tmp"
+      plog("STAC_BIN: " + STAC_BIN)
+      plog("PLATFORM: " + PLATFORM)
+      plog("TITLE: " + TITLE)
+      # PATCH 20231106
+      # if PLATFORM == "S5":
+      #  plog("Not Patching TITLE: "+TITLE)
+      #  if "." in TITLE:
+      #    TITLE=TITLE.split(".")[0]+".SAFE"
+      #  plog("Not Patching TITLE: "+TITLE)
+      plog(f"[*][ TITLE {TITLE}")
+
+    plog("DST_COLLECTION: " + DST_COLLECTION)
+    os.chdir(FDIR_OUT)
+    product.collection = DST_COLLECTION
+    return product
+
+
+# 20261018 publish: patch the item json, upload and verify
+# item is the ( fname, result, seconds ) from the stac item stage
+def publish_product(config, product, item):
+    SRC_PROD_NAME = product.name
+    SRC_PROD_ID = product.node
+    DST_URL = config["target"]["url"]
+    # RUN THE STAC TOOLS [ stac_submit, SRC_DIR is FDIR_OUT ]
+    os.chdir(FDIR_OUT)
+    # 20231108 PATCH SAFE
+
+    # 20231114
+    # fwrite("metadata.xml",pro_meta,FDIR=TITLE) # 20231116
+    # fwrite("metadata.xml",pro_meta,FDIR=TITLE+os.sep+TITLE) # 20231116
+
+    # else:
+    #  TITLE=TITLE # +".SAFE"
+    # if TITLE.split(".")[1] != "SAFE":
+    #  TITLE=TITLE.split(".")[0]+".SAFE"
+    #plog(f"[*][ New Title {TITLE}")
+    # if PLATFORM=="S5":
+    #  STITLE = TITLE.split(".")[0]+".SAFE"
+    # run_stac_tools(STAC_BIN, PLATFORM, STITLE, SRC_DIR)
+    #if PLATFORM=="S5":
+    #run_stac_tools(STAC_BIN, PLATFORM, SRC_PROD_NAME, SRC_DIR)  # 20231116
+    #else:
+    #cmdres,sres=run_stac_tools(STAC_BIN, PLATFORM, SRC_PROD_ID, SRC_DIR)  # 20231116
+    fname, sres = item[:2]  # 20261018
+    # 20231128
+    plog(f"[*] EVENT Stac Tools Result {str(sres)})")
+    if sres!=0:
+      osexit(sres)
+
+    #
+    # The item json of the product [ 20261018 from the stac item worker ]
+    #
+    if fname is None or not os.path.isfile(fname):
+        plog(f"[!][ STAC item {fname} of {SRC_PROD_NAME} not found ]")
+        osexit(P_EXIT_FAILURE)
+    # 20261018 inproc self href is absolute, fread is FDIR_OUT relative
+    fname = os.path.basename(fname)
+    fname_out = UPLOAD_FNAME.format(SRC_PROD_NAME)  # 20261018 one per product
+    plog("fname:" + fname)
+    plog("fname out: " + fname_out)
+
+    #
+    # Patch the JSON
+    #
+    ujh_fname_out, ujh_upload_json = update_json_hrefs(
+        DST_URL,
+        SRC_PROD_ID,
+        fname,
+        fname_out,
+    )
+    return ujh_upload_json  # 20261018 queued for the bulk upload
+
+
+# 20261018 finish: the upload result of the product, verify
+def finish_product(config, product, upload_res):
+    SRC_PROD_NAME = product.name
+    SRC_PROD_ID = product.node
+    DST_COLLECTION = product.collection
+    PLATFORM = product.platform
+
+    #
+    # VERIFY UPLOAD INFO
+    #
+
+    plog("[i] UPLOAD READY")
+    plog("[+] RESULT: ")
+    # dbg_fname_upload=fname_out
+    dbg_src_url = config["source"]["url"]
+    dbg_src_user = config["source"]["username"]
+    dbg_src_prod_id = SRC_PROD_ID
+    dbg_src_prod_name = SRC_PROD_NAME
+    dbg_dst_url = config["target"]["url"]
+    dbg_dst_user = config["target"]["username"]
+    dbg_dst_collection = DST_COLLECTION
+    dbg_dst_platform = PLATFORM
+
+    plog("[ ] SRC URL: " + dbg_src_url)
+    plog("[ ] SRC USR: " + dbg_src_user)
+    plog("[ ] SRC PID: " + dbg_src_prod_id)
+    plog("[ ] SRC NAM: " + dbg_src_prod_name)
+    plog("[ ] DST URL: " + dbg_dst_url)
+    plog("[ ] DST USR: " + dbg_dst_user)
+    #plog("[ ] DST COL: " + dbg_dst_collection)
+    plog("[ ] DST PFR: " + dbg_dst_platform)
+
+    #
+    # WRITE OPERATION [ UPLOAD TO RESTO ]
+    #
+    # upload_res=upload_collection(config,fname_out,DST_COLLECTION+"",PLATFORM)
+    # upload_res = upload_collection(config, fname_out, DST_COLLECTION, PLATFORM)
+    # 20261018 uploaded in bulk by upload_flush, upload_res is this item's part
+
+    # DEBUG
+    plog(f"[R] Upload Result: {upload_res}")
+
+    # UPLOAD RETURN VALUES
+    # print(upload_res)
+    if "ErrorMessage" in upload_res:
+        plog(upload_res)
+        plog(upload_res["ErrorMessage"])
+        if "ErrorCode" in upload_res:
+            plog("[!] Upload Error Code: #" + str(upload_res["ErrorCode"]))
+            # P_EXIT_FAILURE=int(upload_res["ErrorCode"]) # NOTE 20231017 from man
+        osexit(P_EXIT_FAILURE)  # 20261018 not inserted is a failure
+    if "status" in upload_res:
+        if upload_res["status"] == "success":
+            plog("[*] Upload status")
+            plog("[*] uploaded status: " + str(upload_res["status"]))
+            plog("[*] uploaded inserted: " + str(upload_res["inserted"]))
+            plog("[*] uploaded inError: " + str(upload_res["inError"]))
+            plog(
+                "[*] uploaded featureId: " + upload_res["features"][0]["featureId"]
+            )
+            plog(
+                "[*] uploaded productIdentified: "
+                + upload_res["features"][0]["productIdentifier"]
+            )
+            plog("[*] uploaded erorrs: " + str(upload_res["errors"]))
+            plog("[+] UPLOAD O.K.")
+            with open(
+                "upload_" + upload_res["features"][0]["productIdentifier"] + ".log",
+                "w",
+            ) as f:
+              f.write(json.dumps(upload_res))
+
+    # basicauth=None
+    if "status" in upload_res:
+        FEATURE_ID = upload_res["features"][0]["featureId"]
+        # 20261018 verified in batches by verify_submit, see upload_flush
+    else:
+        FEATURE_ID = None
+        plog("[*] Not verifyng upload.")
+
+    plog("[+] PRODUCT UPLOADED.")
+    return {
+        "name": SRC_PROD_NAME,
+        "product": SRC_PROD_ID,
+        "collection": DST_COLLECTION,
+        "featureId": FEATURE_ID,
+        "verified": False,  # 20261018 set by verify_collect
+    }
+
+
+# 20261018 the item is in the target
+def product_verified(product, upload_res):
+    plog(f"[+] UPLOAD VERIFY O.K. {product.name}")
+    # fwrite(SRC_PROD_NAME + "_app_db.json", json.dumps(upload_res))
+    fwrite(VERIFY_FNAME.format(product.name), json.dumps(upload_res))  # 20261018 not an item name
+    cache_release(product.node)  # 20261018
+
+
+# 20261018 one product stage, a ProductExit or a failure ends the product
+# returns the stage result or None and records the code in result
+# 20261018 the seconds of each stage go to result["stages"]
+def product_step(result, fn, *args):
+    global IN_PRODUCT
+    IN_PRODUCT = True
+    started = time.monotonic()
+    try:
+        return prof_call(result["id"], fn.__name__, fn, *args)
+    except ProductExit as e:
+        result["code"] = e.code
+    except Exception as e:
+        exc_handl(e, "[ ERR RS-0000 ][!][ FAILURE IN PRODUCT. ]")
+        result["error"] = str(e)
+    finally:
+        IN_PRODUCT = False
+        stages = result.setdefault("stages", {})
+        stages[fn.__name__] = time.monotonic() - started
+    return None
+
+
+def product_done(result, results):
+    result["seconds"] = (datetime.datetime.now() - result.pop("started")).total_seconds()
+    plog(f"[B][ {result['id']} code: {result['code']} {result['seconds']:.1f} s ]")
+    results.append(result)
+    state_done(result)  # 20261018
+    if result["code"] != P_EXIT_LOCKED:
+        product_unlock(result["id"])
+    metric_inc("products_total", code=result["code"])  # 20261018
+    metrics_write()
+
+
+# 20261018 verified by a former run, the store is not read or written
+def product_skip(result, results):
+    plog(f"[B][ {result['id']} verified by a former run, skipped ]")
+    result["code"] = P_EXIT_SUCESS
+    result["verified"] = True
+    result["resumed"] = "verified"
+    product_done(result, results)
+
+
+# 20261018 uploaded by a former run, only the verification is left
+def product_reverify(config, result, product, job, verifies):
+    finished = {
+        "name": product.name,
+        "product": product.node,
+        "collection": product.collection,
+        "featureId": job["feature_id"],
+        "verified": False,
+    }
+    res = json.loads(job["upload"] or "{}")
+    fut = verify_submit(config, product.collection, [job["feature_id"]])
+    verifies.append((fut, [(result, product, res, finished)]))
+
+
+def product_finish(result, product, finished, results):
+    if finished is not None:
+        result.update(finished)
+        result["code"] = P_EXIT_SUCESS
+    cache_unpin(product.node)
+    product_done(result, results)
+
+
+# 20261018 the patched item is queued per collection, a full queue is sent
+def product_publish(config, result, product, fut, results, uploads, verifies):
+    item = product_step(result, stac_item_result, fut)
+    feature = None
+    if item is not None:
+        if item[2]:  # 0 for the item of a resume
+            metric_observe("stac_item_seconds", item[2], platform=product.platform)
+        if item[0] and item[1] == 0:
+            state_save(result["id"], stage="item", item=os.path.basename(item[0]))
+        feature = product_step(result, publish_product, config, product, item)
+    if feature is None:
+        product_finish(result, product, None, results)
+        return
+    state_save(result["id"], stage="published")
+    product_queue(config, result, product, feature, results, uploads, verifies)
+
+
+def product_queue(config, result, product, feature, results, uploads, verifies):
+    queue = uploads.setdefault(product.collection, [])
+    queue.append((result, product, feature))
+    if len(queue) >= UPLOAD_BATCH:
+        upload_flush(config, uploads.pop(product.collection), results, verifies)
+
+
+# 20261018 one FeatureCollection for the queue, each product finished with
+# its own part of the response, the inserted ones wait for the verification
+def upload_flush(config, queue, results, verifies):
+    features = [feature for _, _, feature in queue]
+    started = time.monotonic()
+    try:
+        upload_res = upload_features(config, queue[0][1].collection, features)
+        metric_observe(
+            "upload_seconds", time.monotonic() - started, collection=queue[0][1].collection
+        )
+    except Exception as e:
+        exc_handl(e, "[ ERR RS-0000 ][!][ FAILURE IN BULK UPLOAD. ]")
+        upload_res = {"ErrorMessage": str(e)}
+    job = []
+    for (result, product, _), res in zip(queue, upload_results(upload_res, features)):
+        finished = product_step(result, finish_product, config, product, res)
+        if finished is None or finished["featureId"] is None:
+            product_finish(result, product, finished, results)
+            continue
+        state_save(
+            result["id"], stage="uploaded", feature_id=finished["featureId"], upload=json.dumps(res)
+        )
+        job.append((result, product, res, finished))
+    if job:
+        ids = [finished["featureId"] for _, _, _, finished in job]
+        verifies.append((verify_submit(config, queue[0][1].collection, ids), job))
+    verify_collect(verifies, results, wait=False)
+
+
+# 20261018 finishes the products of the verifications done [ all with wait ]
+def verify_collect(verifies, results, wait=True):
+    for fut, job in list(verifies):
+        if not wait and not fut.done():
+            continue
+        verifies.remove((fut, job))
+        found = set()
+        error = "item not found in the target"
+        try:
+            found = fut.result()
+        except Exception as e:
+            exc_handl(e, "[ ERR RS-0000 ][!][ FAILURE IN VERIFY. ]")
+            error = str(e)
+        for result, product, res, finished in job:
+            if finished["featureId"] in found:
+                product_verified(product, res)
+                finished["verified"] = True
+                product_finish(result, product, finished, results)
+            else:
+                result.update(finished)
+                result["error"] = error
+                # 20261018 uploaded again by the next run, not only verified
+                state_save(result["id"], stage="published", feature_id=None)
+                product_finish(result, product, None, results)
+
+
+# 20261018 uploaded but not verified products, to be registered again
+def verify_report(results):
+    missing = [x["id"] for x in results if x.get("featureId") and not x.get("verified")]
+    if missing:
+        stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        fname = VERIFY_MISSING_FNAME.format(stamp)
+        fwrite(fname, "\n".join(missing) + "\n")
+        plog(f"[!][ {len(missing)} items missing in the target, requeue: -f {FDIR_OUT}{fname} ]")
+    return missing
+
+
+# 20261018 BATCH MODE
+# one config, one http client per host and one lock for all the ids, a failing
+# product does not stop the batch, the results are written to the summary
+# 20261018 pipeline: products are staged one after another in this process,
+# their stac items are made in the process pool meanwhile and published in
+# order, at most STAC_INFLIGHT staged products per worker wait for an item
+# 20261018 the items go to resto in FeatureCollections of UPLOAD_BATCH items
+# per collection, the rest is sent when the batch is done
+# 20261018 warm: the stac pool is kept for the next batch [ daemon ]
+def register_batch(config, IDS, warm=False):
+    force = "--force" in CMD_OPTS  # 20261018 verified ones too, no resume
+    state_open()
+    results = []
+    inflight = []
+    uploads = {}  # collection: [ ( result, product, item json ) ]
+    verifies = []  # [ ( future of the found featureIds, uploaded products ) ]
+    limit = max(1, STAC_WORKERS) * STAC_INFLIGHT
+    try:
+        for INP_PROD_ID in IDS:
+            if DAEMON_STOP.is_set():  # 20261018 the rest stays in the spool
+                plog("[B][ Stop requested, no further products ]")
+                break
+            result = {"id": INP_PROD_ID, "code": P_EXIT_FAILURE, "error": None}
+            result["started"] = datetime.datetime.now()
+            if not force and INP_PROD_ID in STATE_VERIFIED:  # 20261018
+                product_skip(result, results)
+                continue
+            if not product_lock(INP_PROD_ID):  # 20261018
+                plog(f"[B][ {INP_PROD_ID} locked by another instance, skipped ]")
+                result["code"] = P_EXIT_LOCKED
+                result["error"] = "locked by another instance"
+                product_done(result, results)
+                continue
+            job = None if force else state_get(INP_PROD_ID)
+            if job and job["verified"]:  # by another instance meanwhile
+                product_skip(result, results)
+                continue
+            product, stage = state_resume(job)
+            if product is None:
+                product = product_step(result, stage_product, config, INP_PROD_ID)
+                stage = "staged"
+            else:
+                cache_pin(product.node)
+                result["resumed"] = stage
+                plog(f"[B][ {INP_PROD_ID} resumed after the {stage} stage ]")
+            if product is None:
+                staged = {p.node for _, p, _ in inflight}
+                staged |= {p.node for q in uploads.values() for _, p, _ in q}
+                staged |= {p.node for _, job in verifies for _, p, _, _ in job}
+                for TITLE in set(CACHE_PINNED) - staged:
+                    cache_unpin(TITLE)  # pinned before the stage failed
+                product_done(result, results)
+                continue
+            result["name"] = product.name
+            if "resumed" not in result:
+                state_save(
+                    INP_PROD_ID,
+                    name=product.name,
+                    stage="staged",
+                    product=json.dumps(product.to_state()),
+                    bytes=cache_du(patch_fdir(product.node)),
+                )
+            if stage == "uploaded":
+                product_reverify(config, result, product, job, verifies)
+                continue
+            if stage == "published":
+                feature = json.loads(fread(UPLOAD_FNAME.format(product.name)))
+                product_queue(config, result, product, feature, results, uploads, verifies)
+                continue
+            if stage == "item":
+                fut = Future()
+                fut.set_result((patch_fdir(None) + job["item"], 0, 0))
+            else:
+                fut = stac_submit(product)
+            inflight.append((result, product, fut))
+            while len(inflight) >= limit:
+                product_publish(config, *inflight.pop(0), results, uploads, verifies)
+        while inflight:
+            product_publish(config, *inflight.pop(0), results, uploads, verifies)
+        for col in list(uploads):
+            upload_flush(config, uploads.pop(col), results, verifies)
+        verify_collect(verifies, results)
+        verify_report(results)
+    finally:
+        cache_unpin_all()
+        product_unlock_all()
+        if not warm:
+            stac_pool_shutdown()
+    batch_summary(results)
+    return results
+
+
+def batch_summary(results):
+    failed = [x for x in results if x["code"] != P_EXIT_SUCESS]
+    plog(f"[B][ BATCH: {len(results)} products, {len(failed)} failed ]")
+    for x in results:
+        plog(
+            f"[B][ {x['id']} {x.get('name')} code: {x['code']} "
+            f"verified: {x.get('verified', False)} error: {x['error']} ]"
+        )
+    if len(results) > 1:
+        stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        stamp = f"{stamp}_{os.getpid()}"  # 20261018 instances share FDIR_OUT
+        fwrite(BATCH_SUMMARY_FNAME.format(stamp), json.dumps(results, indent=1))
+
+
+# 20261018 DAEMON
+# -D: *.ids files of the spool are claimed by an flock and a rename to
+# *.ids.<pid>.work [ several daemons share a spool ], registered in one
+# batch each over the warm http and stac pools, the ids not reached before
+# a stop go back to the spool, the failed ones to spool/failed
+def daemon_setup(config):
+    global DAEMON_SPOOL, DAEMON_POLL
+    if "daemon" not in config:
+        return
+    DAEMON_SPOOL = config["daemon"].get("spool", DAEMON_SPOOL)
+    DAEMON_POLL = config["daemon"].getfloat("poll", DAEMON_POLL)
+    plog(f"[*] CFG DAEMON SPOOL: {DAEMON_SPOOL} POLL: {DAEMON_POLL} s")
+
+
+def daemon_signal(signum, frame):
+    if DAEMON_STOP.is_set():
+        plog(f"[D][ Signal {signum} again, exit now ]")
+        raise SystemExit(P_EXIT_FAILURE)
+    plog(f"[D][ Signal {signum}, stopping after the products in flight ]")
+    DAEMON_STOP.set()
+
+
+def spool_write(fname, IDS):
+    ftmp = f"{fname}.{os.getpid()}.tmp"
+    with open(ftmp, "w") as f:
+        f.write("".join(ID + "\n" for ID in IDS))
+    os.replace(ftmp, fname)
+
+
+# the work files of a dead daemon are not locked any more, back to *.ids
+def spool_recover():
+    fdir = patch_fdir(DAEMON_SPOOL)
+    for entry in os.scandir(fdir):
+        if not entry.name.endswith(".work"):
+            continue
+        with open(entry.path, "r") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue  # a running daemon
+            fname = entry.path[: entry.path.rindex(".ids.") + 4]
+            os.rename(entry.path, fname)
+            plog(f"[D][ Recovered {fname} ]")
+
+
+# the oldest unclaimed *.ids, ( open locked file, work file name ) or None
+def spool_claim():
+    fdir = patch_fdir(DAEMON_SPOOL)
+    entries = [x for x in os.scandir(fdir) if x.name.endswith(".ids") and x.is_file()]
+    for entry in sorted(entries, key=lambda x: x.stat().st_mtime):
+        try:
+            f = open(entry.path, "r")
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            work = f"{entry.path}.{os.getpid()}.work"
+            os.rename(entry.path, work)  # fails when claimed meanwhile
+            return f, work
+        except OSError:
+            f.close()
+    return None
+
+
+def spool_done(f, work, IDS, results):
+    fname = work[: work.rindex(".ids.") + 4]
+    done = {x["id"] for x in results}
+    left = [ID for ID in IDS if ID not in done]
+    failed = [x["id"] for x in results if x["code"] not in (P_EXIT_SUCESS, P_EXIT_LOCKED)]
+    if left:
+        spool_write(fname, left)
+        plog(f"[D][ {len(left)} products back to {fname} ]")
+    if failed:
+        fdir = patch_fdir(DAEMON_SPOOL + os.sep + "failed")
+        Path(fdir).mkdir(parents=True, exist_ok=True)
+        spool_write(fdir + os.path.basename(fname), failed)
+        plog(f"[D][ {len(failed)} failed products in {fdir} ]")
+    os.remove(work)
+    f.close()
+
+
+def daemon_run(config):
+    signal.signal(signal.SIGTERM, daemon_signal)
+    signal.signal(signal.SIGINT, daemon_signal)
+    Path(patch_fdir(DAEMON_SPOOL)).mkdir(parents=True, exist_ok=True)
+    spool_recover()
+    state_open()
+    stac_pool()  # workers started and stactools imported before the first id
+    plog(f"[D][ Daemon {os.getpid()} spool {patch_fdir(DAEMON_SPOOL)} ]")
+    try:
+        while not DAEMON_STOP.is_set():
+            claim = spool_claim()
+            if claim is None:
+                DAEMON_STOP.wait(DAEMON_POLL)
+                continue
+            f, work = claim
+            IDS = read_ids(work)
+            plog(f"[D][ {os.path.basename(work)}: {len(IDS)} products ]")
+            results = []
+            try:
+                results = register_batch(config, IDS, warm=True)
+            finally:
+                spool_done(f, work, IDS, results)
+    finally:
+        stac_pool_shutdown()
+        metrics_write()
+    plog("[D][ Daemon stopped ]")
+
+
+# 20261018 HARVEST
+# lists the products ingested after the watermark from the source odata:
+# /odata/v1/Products?$filter=<date_field> gt datetime'...' and ...&$orderby=..
+# paged by $top/$skip, the watermark is persisted per filter in
+# HARVEST_STATE_FNAME and advanced over the registered products only
+def harvest_filter(config):
+    harvest = config["harvest"] if "harvest" in config else {}
+    return (
+        harvest.get("date_field", "IngestionDate"),
+        harvest.get("platform", ""),
+        harvest.get("product_type", ""),
+        harvest.get("start", ""),
+    )
+
+
+def harvest_key(config):
+    date_field, platform, product_type, _ = harvest_filter(config)
+    return f"{date_field}|{platform}|{product_type}"
+
+
+def harvest_watermark(config):
+    try:
+        with open(patch_fdir(None) + HARVEST_STATE_FNAME, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    if harvest_key(config) in state:
+        return state[harvest_key(config)]["ms"]
+    start = harvest_filter(config)[3]
+    if start:
+        dt = datetime.datetime.fromisoformat(start)
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    else:
+        dt = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+    return int(dt.timestamp() * 1000)
+
+
+def harvest_watermark_save(config, ms):
+    fstate = patch_fdir(None) + HARVEST_STATE_FNAME
+    try:
+        with open(fstate, "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state[harvest_key(config)] = {"ms": ms, "date": odata_datetime(ms)}
+    ftmp = f"{fstate}.{os.getpid()}.tmp"
+    with open(ftmp, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(ftmp, fstate)
+    plog(f"[H][ Harvest watermark {odata_datetime(ms)} saved ]")
+
+
+# odata v2 json dates are /Date(milliseconds)/
+def odata_ms(value):
+    return int(re.sub(r"[^0-9-]", "", value))
+
+
+def odata_datetime(ms):
+    dt = datetime.datetime.fromtimestamp(ms / 1000, datetime.timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+def harvest_products(config):
+    date_field, platform, product_type, _ = harvest_filter(config)
+    page_size = HARVEST_PAGE_SIZE
+    max_products = 0
+    if "harvest" in config:
+        page_size = config["harvest"].getint("page_size", page_size)
+        max_products = config["harvest"].getint("max_products", max_products)
+    watermark = harvest_watermark(config)
+    filters = [f"{date_field} gt datetime'{odata_datetime(watermark)}'"]
+    if platform:
+        filters.append(f"startswith(Name,'{platform}')")
+    if product_type:
+        filters.append(f"substringof('{product_type}',Name)")
+    plog(f"[H][ Harvest from {odata_datetime(watermark)} filter: {filters} ]")
+    products = []
+    skip = 0
+    cut = False
+    while True:
+        params = {
+            "$filter": " and ".join(filters),
+            "$orderby": f"{date_field} asc",
+            "$top": str(page_size),
+            "$skip": str(skip),
+            "$format": "json",
+        }
+        res = get_api(
+            config["source"]["url"],
+            "/odata/v1/Products",
+            user=config["source"]["username"],
+            password=config["source"]["password"],
+            params=params,
+        )
+        if not isinstance(res, dict):
+            plog("[!][ Harvest cannot list the source products ]")
+            break
+        page = res.get("d", {}).get("results", [])
+        for val in page:
+            products.append((val["Id"], odata_ms(val[date_field])))
+        plog(f"[H][ Harvest page skip {skip}: {len(page)} products ]")
+        skip += len(page)
+        if len(page) < page_size:
+            break
+        if max_products and skip >= max_products:
+            cut = True
+            break
+    if max_products:
+        products = products[:max_products]
+    if cut:
+        # 20261018 the products of the last timestamp may go on past the cut,
+        # they wait for the next harvest [ the watermark filter is gt ]
+        head = [x for x in products if x[1] < products[-1][1]]
+        products = head or products
+    plog(f"[H][ Harvested {len(products)} new products ]")
+    return products
+
+
+# the watermark moves over the leading run of registered products, a failed
+# product is listed again by the next harvest
+# 20261018 results are in completion order, looked up by the product id,
+# a product without a result [ the batch stopped before it ] is not done
+# 20261018 the filter is gt: the watermark stays below the timestamp of the
+# first product not done, the registered ones sharing it are listed again
+# and skipped as verified by the job state
+def harvest_commit(config, products, results):
+    by_id = {x["id"]: x for x in results}
+    ms = None
+    for ID, product_ms in products:
+        result = by_id.get(ID)
+        if result is None or result["code"] != P_EXIT_SUCESS:
+            if ms == product_ms:
+                ms = max((x for _, x in products if x < product_ms), default=None)
+            break
+        ms = product_ms
+    if ms is not None:
+        harvest_watermark_save(config, ms)
+
 
 ####################################################################
 #
@@ -1382,377 +3847,48 @@ def main():
     # MAIN ERROR RETURN CODE
     #
     P_EXIT_FAILURE = 1
+    log_setup()  # 20261018 defaults until the [log] section is read
 
     #
-    # INITIALIZATION ROUTINES [ lock file test and write ]
-    #
-    dec_proc_run = fexists(FNAME_LOCK)  # TEST IF THE FILE EXISTS
-    if dec_proc_run == 1:
-        plog(f"[*][ register-stack.lock file present in {FDIR_OUT} ]")
-        osexit(P_EXIT_FAILURE)
-
-    #
-    # GET CURRENT PROCESS ID
+    # INITIALIZATION ROUTINES
+    # 20261018 no register-stac.lock, each product is locked in register_batch
     #
-    try:  # OS DEPENDEND
-        pid = os.getpid()
-    except Exception as e:
-        plog(f"[*][ CURRENT PROCESS OPERATING SYSTEM ID: {str(pid)} ERR: {str(e)}")
-
-    #
-    # WRITE DOWN THE LOCK
-    #
-    try:  # OS DEPENDEND
-        fwrite(FNAME_LOCK, str(pid))  # WRITE DOWN THE LOCK FILE
-    except Exception as e:
-        plog(f"[*][ CANNOT START THE PROGRAM. {str(e)}")
 
     # MAIN PROGRAM TRY
     try:
-        #
-        # VARIABLES
-        #
-        SRC_PROD_ID = None
-
-        # FILE VARIABLES
-        INP_PROD_ID = proc_cmd_opts()
-        check_source_id(INP_PROD_ID)
+        IDS = proc_cmd_opts()
         # READ THE CONFIGURATION
         config = read_ini()
-        home_folder = os.getenv("HOME")
-        plog(f"[*][ RETRIEVED HOME FOLDER PATH {home_folder}]")
-
-        # STAC BINARY LOCATION
-        STAC_BIN = "/usr/local/bin/stac"
-        SRC_URL = config["source"]["url"]
-        DST_URL = config["target"]["url"]
-        sub_url = "/collections"
-        SRC_PROD_NAME = None
-
-        # Retrieve product metadata from source
-        pro_meta = get_product_metadata(config, INP_PROD_ID)
-        # 20231116 # get the product id soonest
-        # src_xml = bs.BeautifulSoup(pro_meta, features="xml")
-        # for val in src_xml.find_all("entry"):  # LIMITED
-        #    src_prod_id = str(val.find("Name").get_text())
-        # plog(f"src_prod_id: {src_prod_id}")
-
-        SRC_PROD_NAME = get_product_name_by_id(pro_meta, SRC_URL)
-        PLATFORM = SRC_PROD_NAME[:2]
-        # if PLATFORM!="S5":
-        #  fwrite(SRC_PROD_NAME, pro_meta)  # HERE
-        # SRC_PROD_NAME = SRC_PROD_NAME + ".SAFE"  # 20231116 thx zsustr
-        fnodexml, gsm = get_gsm(config, INP_PROD_ID, SRC_PROD_NAME + ".SAFE")
-        # 20231116 # get the product id soonest
-        src_prod_id=get_src_prod_id_from_gsm(gsm)
-        #src_xml = bs.BeautifulSoup(gsm, features="xml")
-        #src_prod_id = ""
-        #for val in src_xml.find_all("entry"):  # LIMITED
-        #    src_prod_id = str(val.find("Name").get_text())
-        plog(f"src_prod_id: {src_prod_id}")
-        # 20231116
-        # fwrite(SRC_PROD_ID, pro_meta)  # HERE 20231116
-
-        DST_COLLECTION = None
-        SRC_PROD_ID = src_prod_id
-        # DEBUG RUNTIME CHECK
-        plog("[S] SOURCE PRODUCT ID   : " + SRC_PROD_ID)
-        plog("[S] SOURCE PRODUCT NAME : " + SRC_PROD_NAME)
-        plog("[S] SOURCE USER         : " + config["source"]["username"])
-        plog("[S] SOURCE HOST         : " + SRC_URL)
-        plog("[T] TARGET USER         : " + config["target"]["username"])
-        plog("[T] TARGET HOST         : " + DST_URL)
-        # plog("[I] TITLE               : " + TITLE) # 20231116
-        plog("[I] PLATFORM            : " + PLATFORM)
-        #
-        # TEST SOURCE AND TARGET AVAILABILITY [ TESTS ONLY? 20231030 ]
-        #
-        plog("[0] EVENT: getting source metadata manifest safe")
-        DST_COLLECTION = translate_prod2col([SRC_PROD_ID], PLATFORM, DST_COL_TEST_PREFIX)
-        #plog("DST_COLLECTION: " + DST_COLLECTION)        # 20231117
-        #DST_FILE=f"{FDIR_OUT}{os.sep}{SRC_PROD_ID}"
-        if PLATFORM == "S5":
-          #SRC_DIR=f"{SRC_PROD_ID}"
-          #TMP_DIR=f"{SRC_PROD_ID}_tmp{os.sep}"
-          #SRC_FILE=f"{TMP_DIR}{SRC_PROD_ID}"
-          #DST_FILE=f"{SRC_PROD_ID}{os.sep}{SRC_PROD_ID}"
-          #FILE_TEST=fexists(DST_FILE)
-          TRG_FNAME=f"{SRC_PROD_ID}"
-          #DST_FNAME=f"{SRC_PROD_ID}{os.sep}{SRC_PROD_ID}"
-          #FILE_TEST=fexists(DST_FNAME)
-          #TRG_TEST=fexists(TRG_FNAME)
-          #plog(f"[*] FILE_TEST {str(FILE_TEST)} {DST_FNAME}")
-          # 20231129
-          # TRY=1
-          # if TRG_TEST == 0:  # TEST IF THE FILE EXISTS
-          #   if TRY==1:
-          #     try:
-          #      shutil.move(FDIR_OUT+os.sep+SRC_DIR,FDIR_OUT+os.sep+TMP_DIR)
-          #      plog(f"[*] mv {SRC_DIR} {TMP_DIR}")
-          #    except Exception as e:
-          #      exc_handl(e, "[ ERR RS-1201 ][!][ FAILURE IN MAIN. ]")
-          #      plog(f"[ S5 ERROR ][ {str(e)} ]")
-          #      TRY=0
-          #  if TRY==1:
-          #    try:
-          #      shutil.move(FDIR_OUT+os.sep+SRC_FILE,FDIR_OUT+os.sep+TRG_FNAME)
-          #      plog(f"[*] mv {SRC_FILE} {DST_FNAME}")
-          #      TRY=0
-          #    except Exception as e:
-          #      exc_handl(e, "[ ERR RS-1202 ][!][ FAILURE IN MAIN. ]")
-          #      plog(f"[ S5 ERROR ][ {str(e)} ]")
-          #  if TRY==1:
-          #    try:
-          #      os.rmdir(FDIR_OUT+os.sep+TMP_DIR)
-          #      plog(f"[*] rmdir {TMP_DIR}")
-          #    except Exception as e:
-          #      exc_handl(e, "[ ERR RS-1203 ][!][ FAILURE IN MAIN. ]")
-          #      plog(f"[ S5 ERROR ][ {str(e)} ]")
-          #      TRY=0
-          #plog(f"[*] FILE_TEST {TRG_TEST} {fexists(TRG_FNAME)} {str(TRG_FNAME)}")
-          TRG_TEST=fexists(TRG_FNAME)
-          if TRG_TEST == 0:
-            fname_manifest = get_source_metadata_manifest_safe(
-              config, INP_PROD_ID, SRC_PROD_ID, PLATFORM
-            )
-          plog(f"[0] EVENT: has source metadata manifest safe {fname_manifest}")
-          exit(0) # TMP 20231129
-        #plog(f"[0] EVENT: has source metadata manifest safe {fname_manifest}")
-        elif PLATFORM == "S1" or PLATFORM == "S2" or PLATFORM == "S3":
-
-          metadata = get_source_metadata_all(SRC_PROD_ID, SRC_PROD_ID, PLATFORM)
-          plog(f"[I] metadata type: {str(type(metadata))}")
-          fnodexml, gsm = get_gsm(config, INP_PROD_ID, SRC_PROD_ID)
-          titles = update_source_metadata_nodexml(fnodexml, SRC_PROD_NAME)
-          SUFFIX = get_suffix_from_titles(titles)
-          plog(f"[*] titles: {str(titles)} SUFFIX: {SUFFIX}")
-          plog("[*] SRC_PROD_ID: " + SRC_PROD_ID)
-          # PLACEHOLDER FOR FIXED PROC_CMD_OPTS
-          # Get the manifest.safe
-          # GET ALL SOURCE METADATA - only for given sentinels
-          # if PLATFORM == "S1" or PLATFORM == "S2":
-          # Update node.xml source metadata
-
-          # ADV DEBUG
-          # plog("P_ID: " + SRC_PROD_ID)
-          # plog("titles: " + str(titles))
-          #
-          plog(
-              f"[*] titles {titles} PLATFORM {PLATFORM} COL_PREFIX {DST_COL_TEST_PREFIX}"
-          )
-
-          #
-          # GET DESTIONATION COLLECTION ID FROM PRODUCT ID
-          # 20231128
-          # DST_COLLECTION = translate_prod2col(titles, PLATFORM, DST_COL_TEST_PREFIX)
-          # plog("DST_COLLECTION: " + DST_COLLECTION)
-
-          src_fnames, src_paths = get_source_metadata_all(
-              SRC_PROD_ID, SRC_PROD_ID, PLATFORM
-          )
-          # ADV DEBUG
-          # plog(f"src_fnames: {src_fnames[:3]}")
-          # plog(f"src_paths: {src_paths[:3]}")
-
-          #
-          # Patch the metadata
-          #
-          urls2, src_fpaths2, src_fnames2 = metadata_json_patch(
-              config, SRC_URL, src_fnames, src_paths, INP_PROD_ID, SRC_PROD_ID
-          )
-
-          plog("URLS2: " + str(urls2))
-          # These are the larger downloads
-          get_metadata_file(SRC_PROD_ID, config, urls2, src_fpaths2, src_fnames2)
-
-          # ADV DEBUG
-          # plog("src_fnames[:3] " + str(src_fnames[:3]))
-          # plog("src_fpaths[:3] " + str(src_fpaths2[:3]))
-          # plog("urls2[:3] " + str(urls2[:3]))
-
-          # if titles:
-          #    if len(titles) > 0:
-          #        SRC_PROD_NAME = titles[0]
-          #    else:
-          #        SRC_PROD_NAME = titles
-          #plog(f"[*][ {SRC_PROD_NAME} ]")
-          #DST_COLLECTION = translate_prod2col(
-          #    [SRC_PROD_NAME], PLATFORM, DST_COL_TEST_PREFIX
-          #)  # 20231109
-
-          #
-          # DEBUG ID AND NAMES
-          #
-          plog("SOURCE PRODUCT ID: " + SRC_PROD_ID)
-          plog("PLATFORM: " + PLATFORM)
-          # Translate source product ID to target collection ID
-          # TBD REVIEW HERE CHECK IF COLLECTION EXISTS IN TARGET
-          # Run the stac tools [ TBD REVIEW TEST ONLY FOR S2A 20231018 ]
-          plog("[>] Run the stac tools [...]")
-          TITLE = titles[0]
-          # SRC_DIR="./tmp"
-          plog("STAC_BIN: " + STAC_BIN)
-          plog("PLATFORM: " + PLATFORM)
-          plog("TITLE: " + TITLE)
-          # PATCH 20231106
-          # if PLATFORM == "S5":
-          #  plog("Not Patching TITLE: "+TITLE)
-          #  if "." in TITLE:
-          #    TITLE=TITLE.split(".")[0]+".SAFE"
-          #  plog("Not Patching TITLE: "+TITLE)
-          plog(f"[*][ TITLE {TITLE}")
-
-        plog("DST_COLLECTION: " + DST_COLLECTION)
-        # RUN THE STAC TOOLS
-        SRC_DIR = "./"  # this supposes the os.chdir
-        plog("SRC_DIR: " + SRC_DIR)
-        os.chdir(FDIR_OUT)
-        # 20231108 PATCH SAFE
-
-        # 20231114
-        # fwrite("metadata.xml",pro_meta,FDIR=TITLE) # 20231116
-        # fwrite("metadata.xml",pro_meta,FDIR=TITLE+os.sep+TITLE) # 20231116
-
-        # else:
-        #  TITLE=TITLE # +".SAFE"
-        # if TITLE.split(".")[1] != "SAFE":
-        #  TITLE=TITLE.split(".")[0]+".SAFE"
-        #plog(f"[*][ New Title {TITLE}")
-        # if PLATFORM=="S5":
-        #  STITLE = TITLE.split(".")[0]+".SAFE"
-        # run_stac_tools(STAC_BIN, PLATFORM, STITLE, SRC_DIR)
-        #if PLATFORM=="S5":
-        #run_stac_tools(STAC_BIN, PLATFORM, SRC_PROD_NAME, SRC_DIR)  # 20231116
-        #else:
-        cmdres,sres=run_stac_tools(STAC_BIN, PLATFORM, SRC_PROD_ID, SRC_DIR)  # 20231116
-        # 20231128
-        plog(f"[*] EVENT Stac Tools Result {str(sres)})")
-        if sres!=0:
-          osexit(sres)
-
-        #
-        # Get the latest json [ TBD REVIEW TEST ONLY FOR S2A 20231018 ]
-        #
-        fname = get_json_ls("./", PLATFORM)  # TBD REVIEW
-        fname_out = "resto-test_upload.json"  # TBD REVIEW
-        plog("fname:" + fname)
-        plog("fname out: " + fname_out)
-
-        #
-        # Patch the JSON
-        #
-        ujh_fname_out, ujh_upload_json = update_json_hrefs(
-            DST_URL,
-            SRC_PROD_ID,
-            fname,
-            fname_out,
-        )
-
-        #
-        # VERIFY UPLOAD INFO
-        #
-
-        plog("[i] UPLOAD READY")
-        plog("[+] RESULT: ")
-        # dbg_fname_upload=fname_out
-        dbg_src_url = config["source"]["url"]
-        dbg_src_user = config["source"]["username"]
-        dbg_src_prod_id = SRC_PROD_ID
-        dbg_src_prod_name = SRC_PROD_NAME
-        dbg_dst_url = config["target"]["url"]
-        dbg_dst_user = config["target"]["username"]
-        dbg_dst_collection = DST_COLLECTION
-        dbg_dst_platform = PLATFORM
-
-        plog("[ ] SRC URL: " + dbg_src_url)
-        plog("[ ] SRC USR: " + dbg_src_user)
-        plog("[ ] SRC PID: " + dbg_src_prod_id)
-        plog("[ ] SRC NAM: " + dbg_src_prod_name)
-        plog("[ ] DST URL: " + dbg_dst_url)
-        plog("[ ] DST USR: " + dbg_dst_user)
-        #plog("[ ] DST COL: " + dbg_dst_collection)
-        plog("[ ] DST PFR: " + dbg_dst_platform)
-
-        #
-        # WRITE OPERATION [ UPLOAD TO RESTO ]
-        #
-        # upload_res=upload_collection(config,fname_out,DST_COLLECTION+"",PLATFORM)
-        upload_res = upload_collection(config, fname_out, DST_COLLECTION, PLATFORM)
-
-        # DEBUG
-        plog(f"[R] Upload Result: {upload_res}")
-
-        # UPLOAD RETURN VALUES
-        # print(upload_res)
-        if "ErrorMessage" in upload_res:
-            plog(upload_res)
-            plog(upload_res["ErrorMessage"])
-            if "ErrorCode" in upload_res:
-                plog("[!] Upload Error Code: #" + str(upload_res["ErrorCode"]))
-                # P_EXIT_FAILURE=int(upload_res["ErrorCode"]) # NOTE 20231017 from man
-                osexit(P_EXIT_FAILURE)
-        if "status" in upload_res:
-            if upload_res["status"] == "success":
-                plog("[*] Upload status")
-                plog("[*] uploaded status: " + str(upload_res["status"]))
-                plog("[*] uploaded inserted: " + str(upload_res["inserted"]))
-                plog("[*] uploaded inError: " + str(upload_res["inError"]))
-                plog(
-                    "[*] uploaded featureId: " + upload_res["features"][0]["featureId"]
-                )
-                plog(
-                    "[*] uploaded productIdentified: "
-                    + upload_res["features"][0]["productIdentifier"]
-                )
-                plog("[*] uploaded erorrs: " + str(upload_res["errors"]))
-                plog("[+] UPLOAD O.K.")
-                with open(
-                    "upload_" + upload_res["features"][0]["productIdentifier"] + ".log",
-                    "w",
-                ) as f:
-                  f.write(json.dumps(upload_res))
-
-        # basicauth=None
-        if "status" in upload_res:
-            # resto_url="resto-test.c-scale.zcu.cz"
-            resto_url = "https://" + config["target"]["url"]
-            sub_url = (
-                "/collections/"
-                + DST_COLLECTION
-                + "/"
-                + "items/"
-                + upload_res["features"][0]["featureId"]
-            )
-            headers = {"Content-Type": "application/json; charset=utf-8"}
-            ruser = config["target"]["username"].strip()
-            rpass = config["target"]["password"].strip()
-            # print(ruser+" "+rpass) # DEBUG
-            basicauth = HTTPBasicAuth(ruser, rpass)
-            plog(resto_url + sub_url)
-            resp = requests.get(resto_url + sub_url, headers=headers, auth=basicauth)
-            # print(resp.text) # DEBUG
-            upload_verify_res = json.loads(resp.text)
-            if "id" in upload_verify_res:
-                if upload_verify_res["id"] == upload_res["features"][0]["featureId"]:
-                    plog("[+] UPLOAD VERIFY O.K.")
-                    # fwrite(SRC_PROD_NAME + "_app_db.json", json.dumps(upload_res))
-                    fwrite(SRC_PROD_NAME + ".json", json.dumps(upload_res))
+        if METRICS_PORT and ("-H" in CMD_OPTS or "-D" in CMD_OPTS or len(IDS) > 1):
+            metrics_serve()  # 20261018
+        if "-D" in CMD_OPTS:  # 20261018 daemon mode
+            daemon_run(config)
+            osexit(P_EXIT_SUCESS)
+        if "-H" in CMD_OPTS:  # 20261018 harvest mode
+            products = harvest_products(config)
+            results = register_batch(config, [ID for ID, _ in products])
+            harvest_commit(config, products, results)
+            if not results:
+                osexit(P_EXIT_SUCESS)
         else:
-            plog("[*] Not verifyng upload.")
-
+            results = register_batch(config, IDS)
         plog("[+] PROGRAM COMPLETED. Exiting...")
 
         # RETURN CONTROL TO SHELL
+        if len(results) == 1:
+            osexit(results[0]["code"])
+        for result in results:
+            if result["code"] != P_EXIT_SUCESS:
+                osexit(P_EXIT_FAILURE)
         osexit(P_EXIT_SUCESS)  # 20231016
     except Exception as e:
         if e is None:
             e = str("Undef")
             exc_handl(e, "[ ERR RS-1000 ][!][ FAILURE IN MAIN. ]")
-        # REMOVE THE LOCK FILE
         exc_handl(e, "[ ERR RS-0000 ][!][ FAILURE IN MAIN. ]")
-        # rmlock()
         # RETURN CONTROL TO SHELL
         osexit(P_EXIT_FAILURE)  # 20231016
 
 
-main()
+if __name__ == "__main__":  # 20261018 the stac pool workers import this file
+    main()